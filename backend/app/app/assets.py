@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import gzip
+import hashlib
+import mimetypes
+from flask import request, send_file, Response
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Static files are listed in a manifest with their content hashes, built once
+# with `python assets.py` (or in memory at startup if that wasn't run). The
+# build also writes .gz and, with the brotli module installed, .br variants.
+# Requests are then answered from the in-memory manifest: fingerprinted URLs
+# (/assets/main.<hash>.js) are cached forever, everything else is revalidated
+# by ETag, and index.html is kept in memory with its references fingerprinted.
+# The fingerprinted files only exist in the manifest, so they live under
+# /assets, which nginx passes through, rather than /static, which it serves
+# straight from disk.
+prefix = "/assets/"
+
+compressible = ("text/", "application/javascript", "application/json", "image/svg+xml")
+variants = ((".br", "br"), (".gz", "gzip"))
+
+def static_files(folder):
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if name.endswith((".gz", ".br")) or name in ("manifest.json", ".DS_Store"):
+                continue
+            full = os.path.join(root, name)
+            yield os.path.relpath(full, folder).replace(os.sep, "/"), full
+
+def fingerprinted(path, digest):
+    stem, ext = os.path.splitext(path)
+    return "{}.{}{}".format(stem, digest[:12], ext)
+
+def build(folder, write=True):
+    manifest = {}
+    for path, full in static_files(folder):
+        with open(full, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        entry = { "hash": digest, "type": mimetype, "size": len(data), "encodings": [] }
+        if write and mimetype.startswith(compressible):
+            for suffix, encoding, compress in ((".gz", "gzip", lambda d: gzip.compress(d, 9)),
+                                               (".br", "br", brotli and brotli.compress)):
+                if compress:
+                    packed = compress(data)
+                    if len(packed) < len(data):
+                        with open(full + suffix, "wb") as f:
+                            f.write(packed)
+                        entry["encodings"].append(encoding)
+        manifest[path] = entry
+    if write:
+        with open(os.path.join(folder, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+class Assets(object):
+    def __init__(self, folder):
+        self.folder = folder
+        try:
+            with open(os.path.join(folder, "manifest.json")) as f:
+                self.manifest = json.load(f)
+        except (IOError, ValueError):
+            self.manifest = build(folder, write=False)
+        self.fingerprints = { fingerprinted(p, e["hash"]): p for p, e in self.manifest.items() }
+        with open(os.path.join(folder, "index.html")) as f:
+            index = f.read()
+        for path, entry in self.manifest.items():
+            index = index.replace('"/static/{}"'.format(path),
+                                  '"{}{}"'.format(prefix, fingerprinted(path, entry["hash"])))
+        self.index = index.encode()
+        self.index_etag = hashlib.sha256(self.index).hexdigest()[:32]
+
+    def index_response(self):
+        if self.index_etag in request.if_none_match:
+            return Response(status=304, headers={ "ETag": '"{}"'.format(self.index_etag) })
+        return Response(self.index, mimetype="text/html",
+                        headers={ "ETag": '"{}"'.format(self.index_etag),
+                                  "Cache-Control": "no-cache" })
+
+    # Response for a static path, or None if there is no such file
+    def response(self, path):
+        immutable = path in self.fingerprints
+        path = self.fingerprints.get(path, path)
+        entry = self.manifest.get(path)
+        if not entry:
+            return None
+        headers = { "ETag": '"{}"'.format(entry["hash"][:32]),
+                    "Cache-Control": immutable and "public, max-age=31536000, immutable"
+                                     or "public, max-age=300",
+                    "Vary": "Accept-Encoding" }
+        if entry["hash"][:32] in request.if_none_match:
+            return Response(status=304, headers=headers)
+        full = os.path.join(self.folder, path)
+        for suffix, encoding in variants:
+            if encoding in entry["encodings"] and encoding in request.accept_encodings:
+                full += suffix
+                headers["Content-Encoding"] = encoding
+                break
+        r = send_file(full, mimetype=entry["type"], add_etags=False, conditional=False)
+        r.headers.pop("Content-Disposition", None)
+        for k, v in headers.items():
+            r.headers[k] = v
+        return r
+
+if __name__ == '__main__':
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+    manifest = build(folder)
+    print("Wrote manifest for {} files".format(len(manifest)))
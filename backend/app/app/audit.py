@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import atexit
+import threading
+from datetime import datetime
+import sqlalchemy.event
+from flask import g, request, has_request_context
+from main import db, log
+
+# Append-only record of requests and voucher changes, for support. Entries
+# are buffered per process and written as one multi-row insert on a
+# connection of its own once there are batch_size of them or the oldest is
+# flush_interval seconds old, after the response has gone out. Changes made
+# in a transaction are only buffered once it commits.
+batch_size = int(os.getenv("AUDIT_BATCH_SIZE") or 200)
+flush_interval = float(os.getenv("AUDIT_FLUSH_INTERVAL") or 10)
+
+_buffer = []
+_oldest = [None]
+lock = threading.Lock()
+
+def entry(action, borderling_id=None, target_id=None, voucher_id=None, detail=None, **fields):
+    e = { "created": datetime.utcnow(), "action": action,
+          "borderling_id": borderling_id, "target_id": target_id,
+          "voucher_id": voucher_id, "ip": None, "method": None, "path": None,
+          "status": None, "detail": detail and json.dumps(detail, default=str) }
+    e.update(fields)
+    if has_request_context():
+        e["ip"] = e["ip"] or request.remote_addr
+        if borderling_id is None:
+            e["borderling_id"] = g.get("audit_borderling")
+    return e
+
+def buffer(entries):
+    if not entries:
+        return
+    with lock:
+        if not _buffer:
+            _oldest[0] = time.monotonic()
+        _buffer.extend(entries)
+
+def record(action, **kwargs):
+    buffer([ entry(action, **kwargs) ])
+
+# For changes in the session's current transaction: kept with the session
+# and buffered when it commits, dropped if it doesn't
+def record_change(action, **kwargs):
+    db.session.info.setdefault("audit", []).append(entry(action, **kwargs))
+
+@sqlalchemy.event.listens_for(db.session, "after_commit")
+def committed(session):
+    buffer(session.info.pop("audit", []))
+
+@sqlalchemy.event.listens_for(db.session, "after_transaction_end")
+def transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("audit", None)
+
+def due():
+    return len(_buffer) >= batch_size or (
+        _buffer and time.monotonic() - _oldest[0] > flush_interval)
+
+def flush():
+    # models imports this module before it defines AuditLog
+    from models import AuditLog
+    with lock:
+        entries = _buffer[:]
+        del _buffer[:]
+    if not entries:
+        return 0
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(AuditLog.__table__.insert().values(entries))
+    except Exception as e:
+        log.error("Audit: lost {} entries: {}".format(len(entries), e))
+        return 0
+    return len(entries)
+
+# Who the current request is about, once a view knows
+def identify(borderling_id):
+    if has_request_context():
+        g.audit_borderling = borderling_id
+
+def finish_request(response):
+    if request.path.startswith(("/api/", "/_/webhooks/")):
+        forwarded = request.headers.get("X-Forwarded-For")
+        # The path only, the query string may hold an access_token
+        record("request", method=request.method, path=request.path[:1000],
+               status=response.status_code,
+               detail=forwarded and { "forwarded_for": forwarded })
+    if due():
+        response.call_on_close(flush)
+    return response
+
+def init_app(app):
+    app.after_request(finish_request)
+
+atexit.register(flush)
@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+import json
+import jwt
+from jwt.algorithms import RSAAlgorithm
+import requests
+from flask import g, request
+from main import log, oidc_issuer
+
+# Access tokens are checked locally against the issuer's signing keys
+# ("local"), or by asking the issuer about every new token ("introspect").
+# Local validation falls back to introspection when the keys can't be had.
+# Either way the token has to be meant for us: its audience has to include
+# OIDC_AUDIENCE, by default our client id.
+validation = os.getenv("OIDC_VALIDATION") or "local"
+jwks_uri = os.getenv("OIDC_JWKS_URI") or oidc_issuer + "/protocol/openid-connect/certs"
+introspection_uri = (os.getenv("OIDC_INTROSPECTION_URI") or
+                     oidc_issuer + "/protocol/openid-connect/token/introspect")
+jwks_refresh = float(os.getenv("OIDC_JWKS_REFRESH") or 3600)
+client_id = os.getenv("OID_ID") or 'memberships-backend'
+audience = os.getenv("OIDC_AUDIENCE") or client_id
+algorithms = ["RS256", "RS384", "RS512"]
+introspection_cache_size = 10000
+
+_keys = {}
+_keys_fetched = 0
+_keys_lock = threading.Lock()
+_introspected = OrderedDict()
+_introspected_lock = threading.Lock()
+
+def fetch_keys():
+    r = requests.get(jwks_uri, timeout=5)
+    r.raise_for_status()
+    return { k["kid"]: RSAAlgorithm.from_jwk(json.dumps(k))
+             for k in r.json()["keys"]
+             if k.get("use", "sig") == "sig" and k.get("alg") in algorithms }
+
+# Keys are refreshed every jwks_refresh seconds, and on unknown key ids at
+# most every 10 seconds so a key rotation is picked up without flooding the
+# issuer with bogus tokens
+def signing_key(kid):
+    global _keys, _keys_fetched
+    age = time.monotonic() - _keys_fetched
+    if age > jwks_refresh or (kid not in _keys and age > 10):
+        with _keys_lock:
+            if _keys_fetched == 0 or time.monotonic() - _keys_fetched > 10:
+                _keys = fetch_keys()
+                _keys_fetched = time.monotonic()
+                log.info("Fetched signing keys: {}".format(list(_keys)))
+    if kid not in _keys:
+        raise LookupError("Unknown signing key {}".format(kid))
+    return _keys[kid]
+
+def verify_locally(token):
+    key = signing_key(jwt.get_unverified_header(token).get("kid"))
+    return jwt.decode(token, key, algorithms=algorithms, issuer=oidc_issuer,
+                      audience=audience)
+
+def for_us(info):
+    aud = info.get("aud")
+    return audience in (aud if isinstance(aud, list) else [aud])
+
+# Introspection results are kept until the token expires, for at most the
+# introspection_cache_size most recent tokens
+def introspect(token):
+    now = time.time()
+    with _introspected_lock:
+        info = _introspected.get(token)
+    if info and info.get("exp", 0) > now:
+        return info
+    # The issuer being down is a 401, not a 500 from every route
+    try:
+        r = requests.post(introspection_uri, timeout=5,
+                          data={ "token": token,
+                                 "client_id": client_id,
+                                 "client_secret": os.getenv("OID_SECRET") })
+        info = r.status_code == 200 and r.json()
+    except (requests.RequestException, ValueError) as e:
+        log.warn("Unable to introspect token: {}".format(e))
+        return None
+    if not info or not info.get("active"):
+        log.info("Introspection rejected token: {} {}".format(r.status_code, r.text))
+        return None
+    if not for_us(info):
+        log.info("Introspection: token for {}, not {}".format(info.get("aud"), audience))
+        return None
+    if "exp" in info:
+        with _introspected_lock:
+            _introspected[token] = info
+            while len(_introspected) > introspection_cache_size:
+                _introspected.popitem(last=False)
+    return info
+
+def token_info(token):
+    if validation == "local":
+        try:
+            return verify_locally(token)
+        except jwt.InvalidTokenError as e:
+            log.info("Rejected token: {}".format(e))
+            return None
+        except (LookupError, ValueError, requests.RequestException) as e:
+            log.warn("Unable to validate token locally, introspecting: {}".format(e))
+    return introspect(token)
+
+# Drop-in for flask_oidc's accept_token, sets g.oidc_token_info the same way
+def accept_token(require_token=False):
+    def wrapper(view):
+        @wraps(view)
+        def decorated(*args, **kwargs):
+            token = None
+            auth = request.headers.get("Authorization", "")
+            if auth.startswith("Bearer "):
+                token = auth.split(None, 1)[1].strip()
+            elif "access_token" in request.values:
+                token = request.values["access_token"]
+            info = token and token_info(token)
+            if info:
+                g.oidc_token_info = info
+            elif require_token:
+                return (json.dumps({ "error": "invalid_token",
+                                     "error_description": "Token required but invalid" }),
+                        401, { "WWW-Authenticate": "Bearer" })
+            return view(*args, **kwargs)
+        return decorated
+    return wrapper
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+from datetime import datetime, timedelta, date
+from fakes import FakePretix, FakeSMTP, FakeIssuer
+
+# Benchmarks the hot endpoints, the draw and the mailer against a synthetic
+# population, with local stand-ins for Pretix, SMTP and the OIDC issuer.
+#
+#   BENCH_DB=postgresql://localhost/lotto_bench python app/bench.py --population 50000
+#
+# Run it from backend/app like test_data.py, it needs countries.json.
+# BENCH_DB is wiped. Results are written to bench_results/ and compared to
+# the previous run.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--population", type=int, default=10000)
+parser.add_argument("--requests", type=int, default=500, help="per endpoint")
+parser.add_argument("--winners", type=int, default=500)
+parser.add_argument("--quota", type=int, default=None, help="Pretix quota, unlimited by default")
+parser.add_argument("--pool", type=int, default=0, help="pre-created pool vouchers")
+parser.add_argument("--pretix-latency", type=float, default=0.05)
+parser.add_argument("--smtp-latency", type=float, default=0.01)
+parser.add_argument("--out", default="bench_results")
+args = parser.parse_args()
+
+if not os.getenv("BENCH_DB"):
+    sys.exit("Set BENCH_DB to a scratch database, it will be wiped")
+
+pretix_fake = FakePretix(latency=args.pretix_latency, quota=args.quota)
+smtp_fake = FakeSMTP(latency=args.smtp_latency)
+issuer = FakeIssuer()
+os.environ.update({ "LOTTO_DB": os.getenv("BENCH_DB"),
+                    "PRETIX_URL": pretix_fake.url,
+                    "PRETIX_TOKEN": "bench",
+                    "OIDC_ISSUER": issuer.issuer,
+                    "OIDC_JWKS_URI": issuer.jwks_uri,
+                    "OIDC_VALIDATION": "local",
+                    "SMTP_HOST": smtp_fake.host,
+                    "SMTP_PORT": str(smtp_fake.port),
+                    "SMTP_STARTTLS": "0" })
+os.environ.pop("SMTP_USER", None)
+
+from main import *
+from test_data import db_test_data
+import sqlalchemy.event
+import mailer
+
+queries = [0]
+
+@sqlalchemy.event.listens_for(db.engine, "before_cursor_execute")
+def count_query(*args):
+    queries[0] += 1
+
+def chunks(items, n):
+    for i in range(0, len(items), n):
+        yield items[i:i+n]
+
+def populate(n):
+    db.drop_all()
+    db.create_all()
+    db_test_data()
+    lottery = Lottery.query.first()
+    now = datetime.utcnow()
+    lottery.registration_start = now - timedelta(days = 7)
+    lottery.registration_end = now + timedelta(days = 7)
+    lottery.lottery_start = now - timedelta(hours = 1)
+    lottery.lottery_end = now + timedelta(days = 1)
+    lottery.transfer_start = now - timedelta(days = 7)
+    lottery.transfer_end = now + timedelta(days = 7)
+    db.session.commit()
+
+    rows = []
+    for i in range(n):
+        # Born 1950-2018, so some are children
+        dob = date(random.randint(1950, 2018), random.randint(1, 12), random.randint(1, 28))
+        rows.append({ "email": "borderling{}@bench.invalid".format(i),
+                      "lottery_id": lottery.id, "dob": dob, "admin": False })
+    for chunk in chunks(rows, 5000):
+        db.session.execute(Borderling.__table__.insert(), chunk)
+    db.session.commit()
+
+    ids = [ i for (i,) in db.session.query(Borderling.id) ]
+    questions = Question.query.all()
+    options = { q.id: [ o.id for o in q.options ] for q in questions }
+    answers = []
+    for bid in ids:
+        for q in questions:
+            if q.type == "multiple":
+                picked = random.sample(options[q.id], random.randint(0, len(options[q.id])))
+                answers.append({ "borderling_id": bid, "question_id": q.id,
+                                 "text": None, "selections": picked })
+            elif q.type == "datalist":
+                answers.append({ "borderling_id": bid, "question_id": q.id,
+                                 "text": "Sweden", "selections": None })
+            else:
+                answers.append({ "borderling_id": bid, "question_id": q.id,
+                                 "text": str(random.randint(0, 10)), "selections": None })
+    for chunk in chunks(answers, 10000):
+        db.session.execute(Answer.__table__.insert(), chunk)
+    db.session.commit()
+    recount_answers()
+
+    # Some already have vouchers, some of those paid
+    vouchers = []
+    expires = datetime.now() + timedelta(days = 2)
+    for k, bid in enumerate(random.sample(ids, len(ids) // 20)):
+        vouchers.append({ "borderling_id": bid, "code": "BENCH{}".format(k), "expires": expires,
+                          "primary": True, "order": k % 2 and "BO{}".format(k) or None })
+    for chunk in chunks(vouchers, 5000):
+        db.session.execute(Voucher.__table__.insert(), chunk)
+    db.session.commit()
+    invalidate_lottery()
+    return ids
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+def summary(latencies, query_counts, total):
+    return { "requests": len(latencies),
+             "throughput": len(latencies) / total,
+             "p50_ms": percentile(latencies, 0.5) * 1000,
+             "p99_ms": percentile(latencies, 0.99) * 1000,
+             "queries_per_request": sum(query_counts) / len(query_counts) }
+
+def bench_endpoint(client, method, path, n, emails, body=None):
+    latencies, query_counts = [], []
+    started = time.monotonic()
+    for _ in range(n):
+        token = issuer.token(random.choice(emails))
+        before, start = queries[0], time.monotonic()
+        r = client.open(path, method=method, json=body,
+                        headers={ "Authorization": "Bearer " + token })
+        latencies.append(time.monotonic() - start)
+        query_counts.append(queries[0] - before)
+        if r.status_code >= 400:
+            sys.exit("{} {} failed: {} {}".format(method, path, r.status_code, r.data))
+    return summary(latencies, query_counts, time.monotonic() - started)
+
+def bench_draw(winners):
+    if args.pool:
+        pretix.provision_pool(args.pool)
+    before, start = queries[0], time.monotonic()
+    drawn = do_lottery(winners)
+    seconds = time.monotonic() - start
+    return { "winners": drawn,
+             "seconds": seconds,
+             "winners_per_second": drawn / seconds if seconds else 0,
+             "queries": queries[0] - before,
+             "pretix_calls": { name: { "calls": s[0], "errors": s[1],
+                                       "mean_ms": s[2] / s[0] * 1000 if s[0] else 0,
+                                       "max_ms": s[3] * 1000 }
+                               for name, s in pretix.client.stats.items() } }
+
+def bench_mail():
+    sender = mailer.Sender()
+    pending = Mail.query.filter(Mail.sent == None).count()
+    before, start = queries[0], time.monotonic()
+    while mailer.send_pending(sender):
+        pass
+    seconds = time.monotonic() - start
+    sender.close()
+    return { "messages": smtp_fake.messages, "queued": pending, "seconds": seconds,
+             "messages_per_second": smtp_fake.messages / seconds if seconds else 0,
+             "smtp_sessions": smtp_fake.sessions, "queries": queries[0] - before }
+
+def compare(result, previous):
+    for name, now in result["endpoints"].items():
+        then = previous.get("endpoints", {}).get(name)
+        if then:
+            print("  {:<28} p99 {:8.1f}ms -> {:8.1f}ms   queries {:5.1f} -> {:5.1f}".format(
+                name, then["p99_ms"], now["p99_ms"],
+                then["queries_per_request"], now["queries_per_request"]))
+    then = previous.get("draw")
+    if then:
+        print("  {:<28} {:8.1f}/s -> {:8.1f}/s".format(
+            "draw", then["winners_per_second"], result["draw"]["winners_per_second"]))
+
+def main():
+    print("Populating {} borderlings".format(args.population))
+    ids = populate(args.population)
+    emails = [ "borderling{}@bench.invalid".format(i) for i in range(args.population) ]
+    lottery = get_lottery()
+    qs = lottery.questionset_ids[0]
+    client = app.test_client()
+
+    endpoints = {
+        "GET /api/lottery": bench_endpoint(client, "GET", "/api/lottery", args.requests, emails),
+        "GET /api/registration": bench_endpoint(client, "GET", "/api/registration", args.requests, emails),
+        "GET /api/questions/<id>": bench_endpoint(client, "GET", "/api/questions/{}".format(qs),
+                                                  args.requests, emails),
+        "POST /api/answers": bench_endpoint(client, "POST", "/api/answers", args.requests, emails,
+                                            body={ str(q.id): "1" for q in Question.query.filter(
+                                                Question.type == "number") }),
+    }
+    result = { "time": datetime.utcnow().isoformat(),
+               "revision": subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                          stdout=subprocess.PIPE).stdout.decode().strip(),
+               "settings": vars(args),
+               "population": len(ids),
+               "endpoints": endpoints,
+               "draw": bench_draw(args.winners),
+               "mail": bench_mail() }
+    print(json.dumps(result, indent=2, default=str))
+
+    os.makedirs(args.out, exist_ok=True)
+    previous = sorted(f for f in os.listdir(args.out) if f.endswith(".json"))
+    if previous:
+        print("Compared to {}:".format(previous[-1]))
+        with open(os.path.join(args.out, previous[-1])) as f:
+            compare(result, json.load(f))
+    path = os.path.join(args.out, "{}-{}.json".format(
+        datetime.utcnow().strftime("%Y%m%d%H%M%S"), result["revision"] or "unknown"))
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2, default=str)
+    print("Saved {}".format(path))
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,13 @@
 from main import *
+import sys
 
-do_lottery()
-
+# python cron.py [count]   draw up to count winners, or as many as possible
+# python cron.py reclaim   draw as many as expired invitations freed up
+# scheduler.py does this continuously, only one of them may draw at a time.
+lock = advisory_lock("draw")
+if not lock:
+    sys.exit("Someone else is drawing, see /api/admin/draw")
+if sys.argv[1:] == ["reclaim"]:
+    do_reclaim_round()
+else:
+    do_lottery(int(sys.argv[1]) if len(sys.argv) > 1 else None)
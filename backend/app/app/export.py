@@ -0,0 +1,74 @@
+import os
+import io
+import csv
+import json
+from main import db
+from models import Borderling, Answer, questionset_skeleton
+
+# Registrants and their answers for the organizers, as CSV or NDJSON. One
+# query left joins the answers to the borderlings and is read through a
+# server-side cursor in chunks, grouped by borderling on the way, so memory
+# stays flat however many registrants there are.
+
+chunk_size = int(os.getenv("EXPORT_CHUNK_SIZE") or 1000)
+flush_size = 64 * 1024
+
+# The lottery's questions in display order, from the cached skeletons
+def export_questions(lottery):
+    questions = []
+    for qs_id in lottery.questionset_ids:
+        skeleton = questionset_skeleton(qs_id, lottery.questions_version)
+        questions.extend(skeleton and skeleton["questions"] or [])
+    return questions
+
+def registrants(lottery, questions):
+    options = { o["id"]: o["text"] for q in questions for o in q["options"] }
+    rows = db.session.query(
+        Borderling.id, Borderling.email, Borderling.dob,
+        Answer.question_id, Answer.text, Answer.selections).outerjoin(
+            Answer, db.and_(Answer.borderling_id == Borderling.id,
+                            Answer.question_id.in_([ q["id"] for q in questions ]))).filter(
+                                Borderling.lottery_id == lottery.id).order_by(Borderling.id)
+    current, answers = None, {}
+    for bid, email, dob, qid, text, selections in rows.yield_per(chunk_size):
+        if current and current[0] != bid:
+            yield current, answers
+            answers = {}
+        current = (bid, email, dob and dob.isoformat())
+        if qid is not None:
+            answers[qid] = selections and [ options.get(s) or str(s) for s in selections ] or text
+    if current:
+        yield current, answers
+
+def export_csv(lottery):
+    questions = export_questions(lottery)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["id", "email", "dob"] + [ q["question"] for q in questions ])
+    for row, answers in registrants(lottery, questions):
+        values = [ answers.get(q["id"]) for q in questions ]
+        writer.writerow(list(row) + [ "; ".join(v) if isinstance(v, list) else v
+                                      for v in values ])
+        if out.tell() > flush_size:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
+
+def export_ndjson(lottery):
+    questions = export_questions(lottery)
+    buffered = []
+    size = 0
+    for (bid, email, dob), answers in registrants(lottery, questions):
+        line = json.dumps({ "id": bid, "email": email, "dob": dob,
+                            "answers": { str(q["id"]): answers.get(q["id"])
+                                         for q in questions } }) + "\n"
+        buffered.append(line)
+        size += len(line)
+        if size > flush_size:
+            yield "".join(buffered)
+            buffered, size = [], 0
+    yield "".join(buffered)
+
+formats = { "csv": (export_csv, "text/csv"),
+            "ndjson": (export_ndjson, "application/x-ndjson") }
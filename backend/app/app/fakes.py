@@ -0,0 +1,192 @@
+import json
+import re
+import time
+import random
+import threading
+import socketserver
+from urllib.parse import urlsplit, parse_qs
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+# Local stand-ins for Pretix, the SMTP relay and the OIDC issuer, used by
+# bench.py. Each runs on a thread of its own and can add latency to every
+# request to look more like the real thing.
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def delay(latency):
+    if latency:
+        time.sleep(random.uniform(0.5, 1.5) * latency)
+
+class JSONHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"null")
+
+    def reply(self, status, data):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+# Just enough of the Pretix API for the draw and the webhook worker. Vouchers
+# block quota while valid, like the real thing, so draws run out of it.
+class FakePretix(object):
+    def __init__(self, latency=0, quota=None, port=0):
+        self.latency = latency
+        self.quota = quota
+        self.vouchers = {}
+        self.orders = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        fake = self
+
+        class Handler(JSONHandler):
+            def do_GET(self):
+                fake.handle(self, "GET")
+
+            def do_POST(self):
+                fake.handle(self, "POST")
+
+            def do_PATCH(self):
+                fake.handle(self, "PATCH")
+
+        self.server = serve(ThreadingHTTPServer(("127.0.0.1", port), Handler))
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def blocking(self):
+        now = str(datetime.now())
+        return sum(1 for v in self.vouchers.values() if v["valid_until"] > now)
+
+    def handle(self, request, method):
+        delay(self.latency)
+        with self.lock:
+            self.calls += 1
+            url = urlsplit(request.path)
+            path = url.path.split("/events/", 1)[-1].split("/", 1)[-1]
+            m = re.match(r"^(vouchers|orders)/([^/]+)/$", path)
+            if method == "POST" and path == "vouchers/batch_create/":
+                body = request.body()
+                now = str(datetime.now())
+                needed = sum(1 for v in body if v["valid_until"] > now)
+                if self.quota is not None and self.blocking() + needed > self.quota:
+                    return request.reply(400, {"detail": "Quota exceeded"})
+                created = []
+                for v in body:
+                    v = dict(v, id=len(self.vouchers) + 1, redeemed=0)
+                    self.vouchers[v["id"]] = v
+                    created.append(v)
+                return request.reply(201, created)
+            if method == "GET" and path == "vouchers/":
+                codes = parse_qs(url.query).get("code")
+                return request.reply(200, { "next": None, "results": [
+                    v for v in self.vouchers.values() if codes is None or v["code"] in codes ] })
+            if m and m.group(1) == "vouchers" and int(m.group(2)) in self.vouchers:
+                v = self.vouchers[int(m.group(2))]
+                if method == "PATCH":
+                    body = request.body()
+                    now = str(datetime.now())
+                    blocks = body.get("valid_until", v["valid_until"]) > now
+                    if (blocks and v["valid_until"] <= now and self.quota is not None and
+                        self.blocking() >= self.quota):
+                        return request.reply(400, {"detail": "Quota exceeded"})
+                    v.update(body)
+                return request.reply(200, v)
+            if m and m.group(1) == "orders" and m.group(2) in self.orders:
+                return request.reply(200, self.orders[m.group(2)])
+            return request.reply(404, {"detail": "Not found."})
+
+    # A paid order redeeming the voucher with the given code
+    def pay(self, code):
+        voucher = next(v for v in self.vouchers.values() if v["code"] == code)
+        order = "O{}".format(len(self.orders) + 1)
+        self.orders[order] = { "code": order, "secret": "s" + order,
+                               "positions": [ { "voucher": voucher["id"] } ] }
+        return order
+
+    def close(self):
+        self.server.shutdown()
+
+# Accepts mail without TLS or authentication and counts it
+class FakeSMTP(object):
+    def __init__(self, latency=0, port=0):
+        self.latency = latency
+        self.messages = 0
+        self.sessions = 0
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def send(self, line):
+                self.wfile.write((line + "\r\n").encode())
+
+            def handle(self):
+                fake.sessions += 1
+                self.send("220 fake ESMTP")
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode(errors="replace").strip().upper()
+                    if command.startswith(("EHLO", "HELO")):
+                        self.send("250 fake")
+                    elif command == "DATA":
+                        self.send("354 go ahead")
+                        while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                            pass
+                        delay(fake.latency)
+                        fake.messages += 1
+                        self.send("250 queued")
+                    elif command == "QUIT":
+                        self.send("221 bye")
+                        return
+                    else:
+                        self.send("250 ok")
+
+        class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = serve(Server(("127.0.0.1", port), Handler))
+        self.host = "127.0.0.1"
+        self.port = self.server.server_address[1]
+
+    def close(self):
+        self.server.shutdown()
+
+# Serves a JWKS and signs access tokens with the matching key
+class FakeIssuer(object):
+    def __init__(self, port=0):
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                            backend=default_backend())
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.key.public_key()))
+        jwks = { "keys": [ dict(jwk, kid="bench", alg="RS256", use="sig") ] }
+
+        class Handler(JSONHandler):
+            def do_GET(self):
+                self.reply(200, jwks)
+
+        self.server = serve(ThreadingHTTPServer(("127.0.0.1", port), Handler))
+        self.issuer = "http://127.0.0.1:{}/realms/bench".format(self.server.server_port)
+        self.jwks_uri = self.issuer + "/certs"
+
+    def token(self, email, lifetime=3600):
+        from auth import audience
+        now = int(time.time())
+        token = jwt.encode({ "iss": self.issuer, "aud": audience, "sub": email, "email": email,
+                             "iat": now, "exp": now + lifetime },
+                           self.key, algorithm="RS256", headers={ "kid": "bench" })
+        # Bytes from PyJWT 1.x
+        return token.decode() if isinstance(token, bytes) else token
+
+    def close(self):
+        self.server.shutdown()
@@ -1,6 +1,5 @@
-import os
-import smtplib
 from email.message import EmailMessage
+from main import db
 
 #TODO
 # pretty HTML multipart messages
@@ -15,15 +14,16 @@ def new_message(recipient, subject, body):
     msg['To'] = recipient
     return msg
 
-def send_message(msg):
-    s = smtplib.SMTP(os.getenv("SMTP_HOST"))
-    s.connect(os.getenv("SMTP_HOST"))
-    s.starttls()
-    s.login(os.getenv("SMTP_USER"), os.getenv("SMTP_PASS"))
-    s.send_message(msg)
-    s.quit()
+# Queue a message in the outbox, mailer.py does the actual sending. With
+# commit=False it goes out with the caller's transaction.
+def send_message(msg, commit=True):
+    # models imports this module (through pretix) before it defines Mail
+    from models import Mail
+    db.session.add(Mail(recipient = msg['To'], message = msg.as_string()))
+    if commit:
+        db.session.commit()
 
-def registration_complete(recipient):
+def registration_complete(recipient, commit=True):
     msg = new_message(recipient, "You're registered for The Borderland 2019!",
     '''
 Dearest Borderling,
@@ -40,10 +40,10 @@ You can change your answers up until the lottery starts at
 Love,
 The Borderland Membership Team
     ''')
-    send_message(msg)
+    send_message(msg, commit)
 
 
-def voucher_allocated(recipient):
+def voucher_allocated(recipient, commit=True):
     msg = new_message(recipient, "You're invited to The Borderland 2019!",
     '''
 Dearest Borderling,
@@ -57,9 +57,9 @@ Go here: https://memberships.theborderland.se/
 Love,
 The Borderland Membership Team
     ''')
-    send_message(msg)
+    send_message(msg, commit)
 
-def order_complete(recipient):
+def order_complete(recipient, commit=True):
     msg = new_message(recipient, "Your Borderland 2019 membership",
     '''
 Dearest Borderling,
@@ -74,9 +74,9 @@ You can view your receipt at https://memberships.theborderland.se/
 Hugs,
 The Borderland Membership Team
     ''')
-    send_message(msg)
+    send_message(msg, commit)
 
-def gifted_ticket(recipient, sender):
+def gifted_ticket(recipient, sender, commit=True):
     msg = new_message(recipient, "Someone gifted you a membership to The Borderland 2019!",
     '''
 Lovely Borderling,
@@ -93,9 +93,9 @@ You can view the receipt at https://memberships.theborderland.se/
 Hugs,
 The Borderland Membership Team
     '''.format(sender))
-    send_message(msg)
+    send_message(msg, commit)
 
-def voucher_transfer(recipient, sender, expiration):
+def voucher_transfer(recipient, sender, expiration, commit=True):
     msg = new_message(recipient, "You've been invited to The Borderland 2019!",
     '''
 Dearest Borderling,
@@ -109,6 +109,6 @@ Hurry up, it expires {}!
 Hugs,
 The Borderland Membership Team
     '''.format(sender, expiration))
-    send_message(msg)
+    send_message(msg, commit)
 
 
@@ -0,0 +1,80 @@
+from main import *
+import os
+import sys
+import time
+import smtplib
+import email
+import email.policy
+import metrics
+from datetime import datetime, timedelta
+
+# Sends the mail queued by lottomail over a single long-lived SMTP session.
+# Failed messages are retried with exponential backoff.
+batch_size = int(os.getenv("MAIL_BATCH_SIZE") or 50)
+max_attempts = int(os.getenv("MAIL_MAX_ATTEMPTS") or 8)
+poll_interval = float(os.getenv("MAIL_POLL_INTERVAL") or 5)
+
+class Sender(object):
+    def __init__(self):
+        self.smtp = None
+
+    def connect(self):
+        s = smtplib.SMTP(os.getenv("SMTP_HOST"), int(os.getenv("SMTP_PORT") or 25), timeout=30)
+        if (os.getenv("SMTP_STARTTLS") or "1") != "0":
+            s.starttls()
+        if os.getenv("SMTP_USER"):
+            s.login(os.getenv("SMTP_USER"), os.getenv("SMTP_PASS"))
+        self.smtp = s
+
+    def send(self, msg):
+        if not self.smtp:
+            self.connect()
+        try:
+            self.smtp.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # Idle sessions get dropped by the server, reconnect once
+            self.connect()
+            self.smtp.send_message(msg)
+
+    def close(self):
+        if self.smtp:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+def send_pending(sender):
+    now = datetime.utcnow()
+    mails = Mail.query.filter(Mail.sent == None, Mail.next_attempt <= now,
+                              Mail.attempts < max_attempts).order_by(
+                                  Mail.id).limit(batch_size).with_for_update(skip_locked=True).all()
+    for mail in mails:
+        start = time.monotonic()
+        try:
+            sender.send(email.message_from_string(mail.message, policy=email.policy.default))
+            mail.sent = datetime.utcnow()
+            metrics.observe("lotto_smtp_seconds", time.monotonic() - start)
+        except (smtplib.SMTPException, OSError) as e:
+            metrics.count("lotto_smtp_errors_total")
+            mail.attempts += 1
+            mail.error = str(e)[:5000]
+            mail.next_attempt = datetime.utcnow() + timedelta(seconds = min(30 * 2**mail.attempts, 3600))
+            log.warn("Mailer: failed sending {} (attempt {}): {}".format(mail, mail.attempts, e))
+            sender.close()
+    db.session.commit()
+    if mails:
+        metrics.dump()
+    return len(mails)
+
+if __name__ == '__main__':
+    # python mailer.py --once sends everything due and exits
+    sender = Sender()
+    try:
+        while True:
+            if not send_pending(sender):
+                if "--once" in sys.argv:
+                    break
+                time.sleep(poll_interval)
+    finally:
+        sender.close()
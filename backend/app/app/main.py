@@ -1,9 +1,9 @@
 from flask import Flask, jsonify, request, send_file, g
-from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-from flask_oidc import OpenIDConnect
+import flask_sqlalchemy
+from datetime import datetime, timedelta
 import os
-import json
+import sys
+import time
 import logging
 from logging.config import dictConfig
 from flask.logging import default_handler
@@ -12,8 +12,6 @@ from sentry_sdk import capture_exception
 
 os.getenv("SENTRY_URL") and sentry_sdk.init(os.getenv("SENTRY_URL"))
 
-app = Flask(__name__)
-
 # Set up logging
 logging.getLogger().addHandler(default_handler)
 dictConfig({
@@ -31,78 +29,166 @@ dictConfig({
         'handlers': ['wsgi']
     }
 })
+log = logging.getLogger("lotto")
 
-# OID secrets written just to be read again by OIDC_CLIENT_SECRETS below,
-# there's probably a better way to get this into flask_oidc
-with open("/tmp/client_secrets.json", "w") as f:
-    json.dump({
-        'web': {'auth_uri': 'https://account.theborderland.se/auth/realms/master/protocol/openid-connect/auth',
-                'client_id': os.getenv("OID_ID") or 'memberships-backend',
-                'client_secret': os.getenv("OID_SECRET"),
-                'issuer': 'https://account.theborderland.se/auth/realms/master',
-                'redirect_uris': ['https://account.theborderland.se/*'],
-                'token_introspection_uri': 'https://account.theborderland.se/auth/realms/master/protocol/openid-connect/token/introspect',
-                'token_uri': 'https://account.theborderland.se/auth/realms/master/protocol/openid-connect/token',
-                'userinfo_uri': 'https://account.theborderland.se/auth/realms/master/protocol/openid-connect/userinfo'}
-    }, f)
-
-# Flask config
-app.config.update({
-    'SQLALCHEMY_DATABASE_URI': os.getenv("LOTTO_DB"), #or 'sqlite:///test.db'
-    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
-    'OIDC_RESOURCE_SERVER_ONLY': True,
-    'OIDC_CLIENT_SECRETS': '/tmp/client_secrets.json',
-    'OIDC_ID_TOKEN_COOKIE_SECURE': False,
-    'OIDC_REQUIRE_VERIFIED_EMAIL': False,
-    'OIDC_USER_INFO_ENABLED': True,
-    'OIDC_OPENID_REALM': 'memberships-backend',
-    'OIDC_SCOPES': ['openid', 'email'],
-    'OIDC_INTROSPECTION_AUTH_METHOD': 'client_secret_post'
-})
+oidc_issuer = os.getenv("OIDC_ISSUER") or 'https://account.theborderland.se/auth/realms/master'
 
 # Magic value land! TODO make a config store. Some of this belongs in the
 # Lottery class
 host = "pretix.theborderland.se"
+pretix_url = os.getenv("PRETIX_URL") or "https://{}".format(host)
 org = os.getenv("PRETIX_ORG") or "borderland"
 event = os.getenv("PRETIX_EVENT") or "test3"
 expiration_delta = { "days": 2 }
 item = int(os.getenv("PRETIX_ITEM") or 5)
 child_item = 6
+vouchers_per_winner = 2
+draw_batch_size = int(os.getenv("LOTTERY_BATCH_SIZE") or 100)
+draw_concurrency = int(os.getenv("LOTTERY_CONCURRENCY") or 8)
+lottery_cache_ttl = float(os.getenv("LOTTERY_CACHE_TTL") or 30)
+pretix_sync_interval = float(os.getenv("PRETIX_SYNC_INTERVAL") or 300)
 
-
-oidc = OpenIDConnect(app)
-db = SQLAlchemy(app)
 # SQLAlchemy might throw an exception on a dropped idle collection, unhandled
 # by flask even if sqlalchemy automatically reconnects. Send a ping to trigger
 # reconnect before doing anything.
-db.engine.pool._pre_ping = True # TODO look at SQLALCHEMY_POOL_RECYCLE as an alternative
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        options["pool_pre_ping"] = True
+        return super().apply_driver_hacks(app, info, options)
+
+# The engine is created on first use, not here
+db = SQLAlchemy()
+
+# Everything is configured from the environment, so uWSGI can import this
+# once in the master and fork the workers from it
+def create_app():
+    app = Flask(__name__)
+    app.config.update({
+        'SQLALCHEMY_DATABASE_URI': os.getenv("LOTTO_DB"), #or 'sqlite:///test.db'
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    })
+    db.init_app(app)
+    # Lets the workers and scripts use the models without an app context
+    db.app = app
+    import views
+    app.register_blueprint(views.api)
+    metrics.init_app(app)
+    audit.init_app(app)
+    return app
 
 
 # Get the current lottery, in a silly way
 # TODO actually support multiple lotteries
+# It changes about once a year, so each worker keeps a read-only snapshot for
+# lottery_cache_ttl seconds. Changes made through the ORM drop it right away.
+_lottery_cache = (0, None)
+
 def get_lottery():
-    return Lottery.query.first()
+    global _lottery_cache
+    expires, snapshot = _lottery_cache
+    if snapshot is None or time.monotonic() > expires:
+        lottery = Lottery.query.first()
+        snapshot = lottery and LotterySnapshot(lottery)
+        _lottery_cache = (time.monotonic() + lottery_cache_ttl, snapshot)
+    return snapshot
 
-# Assign vouchers as long as we can
-def do_lottery():
+def invalidate_lottery():
+    global _lottery_cache
+    _lottery_cache = (0, None)
+
+# Assign vouchers to up to count winners, or as long as we can if count is
+# None. The eligible pool is shuffled once up front and winners are committed
+# in batches of draw_batch_size. How many were eligible and the time spent
+# per phase go into stats, if given.
+def do_lottery(count=None, stats=None):
     lottery = get_lottery()
-    if lottery.lotteryRunning():
-        while True:
-            borderling = lottery.get_random_borderling()
-            app.logger.info("Cron: drew {}".format(borderling))
-            if borderling:
-                if not borderling.isChild():
-                    if not pretix.get_vouchers(borderling):
-                        break
-            else:
-                break
-    else:
-        app.logger.info("Cron: Lottery not running")
-
-# Yay circular imports!
-from views import *
+    if not lottery.lotteryRunning():
+        log.info("Cron: Lottery not running")
+        return 0
+    # No point asking Pretix for more than the last sync says is left
+    remaining = PretixQuota.remaining(item, timedelta(seconds = 2 * pretix_sync_interval))
+    if remaining is not None:
+        count = min(remaining // vouchers_per_winner, count if count is not None else remaining)
+        log.info("Cron: {} tickets left in Pretix".format(remaining))
+    if count == 0:
+        return 0
+    timings = {}
+    with metrics.timed(timings, "draw"):
+        pool = lottery.draw()
+    if stats is not None:
+        stats.update(eligible = len(pool), timings = timings)
+    log.info("Cron: drawing {} of {} eligible".format(
+        "all" if count is None else count, len(pool)))
+    drawn = 0
+    exhausted = False
+    for start in range(0, len(pool), draw_batch_size):
+        ids = pool[start:start+draw_batch_size]
+        if count is not None:
+            ids = ids[:count - drawn]
+        with metrics.timed(timings, "draw"):
+            # Still eligible: a long draw gives them time to get a voucher
+            # some other way or leave the lottery since draw() looked
+            found = { b.id: b for b in Borderling.query.filter(
+                Borderling.id.in_(ids), Borderling.lottery_id == lottery.id,
+                ~Borderling.vouchers.any()) }
+            drawn_batch = [ found[i] for i in ids if i in found ]
+        log.info("Cron: drew {}".format(drawn_batch))
+        with metrics.timed(timings, "provision"):
+            winners = pretix.allocate_vouchers(drawn_batch)
+        # Those left out stay eligible, but stop drawing once Pretix says no
+        exhausted = len(winners) < len(drawn_batch)
+        drawn += len(winners)
+        with metrics.timed(timings, "mail"):
+            for borderling in winners:
+                lottomail.voucher_allocated(borderling.email, commit=False)
+            db.session.commit()
+        if exhausted or (count is not None and drawn >= count):
+            break
+    log.info("Cron: allocated vouchers to {} borderlings ({})".format(
+        drawn, ", ".join("{} {:.2f}s".format(p, s) for p, s in sorted(timings.items()))))
+    metrics.count("lotto_lottery_winners_total", drawn)
+    for phase, seconds in timings.items():
+        metrics.count("lotto_lottery_phase_seconds_total", seconds, phase=phase)
+    metrics.dump()
+    return drawn
+
+# Give the quota freed up by expired invitations to new winners, including
+# what earlier rounds couldn't. Only what was actually handed out is marked
+# as reoffered. Rounding up is safe, Pretix refuses vouchers beyond the quota.
+def do_reclaim_round():
+    freed = reclaim_expired_vouchers()
+    capacity = unoffered_reclaimed().count()
+    log.info("Cron: reclaimed {} expired vouchers, {} not offered again yet".format(freed, capacity))
+    if not capacity:
+        return 0
+    drawn = do_lottery(-(-capacity // vouchers_per_winner))
+    mark_reoffered(min(capacity, drawn * vouchers_per_winner))
+    return drawn
+
+# Yay circular imports! uWSGI loads this file as app.main, while everything
+# else imports it as main. Make both names the same module, or models would
+# start a second copy of it halfway through the first.
+sys.modules.setdefault("main", sys.modules[__name__])
 from models import *
 import pretix
+import lottomail
+import metrics
+import audit
+
+app = create_app()
+
+# Workers are forked from the master with lazy-apps off, and mustn't share its
+# sockets. Pools reconnect on their own after this.
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
+if postfork:
+    @postfork
+    def reconnect():
+        db.get_engine(app).dispose()
+        pretix.client.session.close()
 
 if __name__ == '__main__':
     if not Lottery.query.first():
@@ -0,0 +1,223 @@
+import os
+import hmac
+import json
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+import sqlalchemy.event
+from sqlalchemy.engine import Engine
+from flask import g, request, has_request_context
+from main import log
+
+# Request, SQL and Pretix/SMTP timings, kept per process and written to a file
+# per process in metrics_dir every few seconds. /_/metrics adds up the files,
+# so all uWSGI workers (and the workers next to them) show up in one
+# Prometheus scrape. Files of processes that have exited, like cron.py runs
+# or a restarted scheduler.py, are folded into exited.json so their counts
+# stay in the totals.
+metrics_dir = os.getenv("METRICS_DIR") or "/tmp/lotto-metrics"
+dump_interval = float(os.getenv("METRICS_DUMP_INTERVAL") or 5)
+slow_request = float(os.getenv("SLOW_REQUEST_SECONDS") or 1)
+# Without it /_/metrics is only served to requests from this host
+metrics_token = os.getenv("METRICS_TOKEN")
+exited_file = "exited.json"
+
+time_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+count_buckets = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+buckets = { "lotto_db_queries_per_request": count_buckets }
+
+# (name, labels) -> value, and (name, labels) -> [cumulative buckets..., sum, count]
+counters = {}
+histograms = {}
+lock = threading.Lock()
+_dumped = [time.monotonic()]
+
+def count(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    bounds = buckets.get(name, time_buckets)
+    with lock:
+        h = histograms.get(key)
+        if not h:
+            h = histograms[key] = [0] * (len(bounds) + 2)
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+# Time spent waiting on something outside, added to the current request's
+def external(name, seconds):
+    if has_request_context() and "external" in g:
+        g.external[name] = g.external.get(name, 0) + seconds
+
+@contextmanager
+def timed(timings, name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.monotonic() - start
+
+@sqlalchemy.event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start"] = time.monotonic()
+
+@sqlalchemy.event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.monotonic() - conn.info.pop("query_start", time.monotonic())
+    count("lotto_db_queries_total")
+    count("lotto_db_seconds_total", seconds)
+    if has_request_context() and "queries" in g:
+        g.queries.append((seconds, statement))
+
+def start_request():
+    g.request_start = time.monotonic()
+    g.queries = []
+    g.external = {}
+
+def finish_request(response):
+    if "request_start" not in g:
+        return response
+    seconds = time.monotonic() - g.request_start
+    route = request.url_rule and request.url_rule.rule or "unmatched"
+    sql_seconds = sum(s for s, _ in g.queries)
+    count("lotto_http_requests_total", route=route, method=request.method,
+          status=str(response.status_code))
+    observe("lotto_http_request_seconds", seconds, route=route)
+    observe("lotto_db_queries_per_request", len(g.queries), route=route)
+    count("lotto_http_db_seconds_total", sql_seconds, route=route)
+    for name, external_seconds in g.external.items():
+        count("lotto_http_external_seconds_total", external_seconds, route=route, service=name)
+    if seconds > slow_request:
+        log.warn("Slow request: {} {} {} took {:.3f}s, {} queries in {:.3f}s{}{}".format(
+            request.method, request.path, response.status_code, seconds,
+            len(g.queries), sql_seconds,
+            "".join(", {} {:.3f}s".format(n, s) for n, s in sorted(g.external.items())),
+            "".join("\n  {:.3f}s {}".format(s, " ".join(q.split())) for s, q in g.queries[:50])))
+    if time.monotonic() - _dumped[0] > dump_interval:
+        dump()
+    return response
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+def snapshot():
+    import pretix
+    with lock:
+        data = { "counters": [ [n, l, v] for (n, l), v in counters.items() ],
+                 "histograms": [ [n, l, list(h)] for (n, l), h in histograms.items() ] }
+    for name, (calls, errors, total, slowest) in list(pretix.client.stats.items()):
+        labels = [("call", name)]
+        data["counters"] += [ ["lotto_pretix_calls_total", labels, calls],
+                              ["lotto_pretix_errors_total", labels, errors],
+                              ["lotto_pretix_seconds_total", labels, total] ]
+    return data
+
+def dump():
+    _dumped[0] = time.monotonic()
+    path = os.path.join(metrics_dir, "{}.json".format(os.getpid()))
+    try:
+        os.makedirs(metrics_dir, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot(), f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        log.warn("Metrics: unable to write {}: {}".format(path, e))
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def add(totals, histos, data):
+    for name, labels, value in data["counters"]:
+        key = (name, tuple(map(tuple, labels)))
+        totals[key] = totals.get(key, 0) + value
+    for name, labels, h in data["histograms"]:
+        key = (name, tuple(map(tuple, labels)))
+        histos[key] = [ a + b for a, b in zip(histos.get(key, [0] * len(h)), h) ]
+
+# Adds the files of exited processes to exited.json
+def fold(paths):
+    exited = os.path.join(metrics_dir, exited_file)
+    totals, histos = {}, {}
+    for path in [exited] + paths:
+        data = read(path)
+        if data:
+            add(totals, histos, data)
+    with open(exited + ".tmp", "w") as f:
+        json.dump({ "counters": [ [n, l, v] for (n, l), v in totals.items() ],
+                    "histograms": [ [n, l, h] for (n, l), h in histos.items() ] }, f)
+    os.replace(exited + ".tmp", exited)
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# Everything written by live processes plus what exited ones left, summed, in
+# Prometheus' text format. Scrapes take turns, so none of them sees a file
+# halfway into exited.json and a counter going down.
+def render():
+    dump()
+    totals, histos = {}, {}
+    with open(os.path.join(metrics_dir, "render.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        processes = [ f for f in os.listdir(metrics_dir) if f.endswith(".json") and f[:-5].isdigit() ]
+        fold([ os.path.join(metrics_dir, f) for f in processes if not alive(int(f[:-5])) ])
+        for filename in os.listdir(metrics_dir):
+            if filename.endswith(".json"):
+                data = read(os.path.join(metrics_dir, filename))
+                if data:
+                    add(totals, histos, data)
+
+    lines = []
+    for name in sorted({ n for n, _ in totals }):
+        lines.append("# TYPE {} counter".format(name))
+        for (n, labels), value in sorted(totals.items()):
+            if n == name:
+                lines.append("{}{} {}".format(name, format_labels(labels), value))
+    for name in sorted({ n for n, _ in histos }):
+        lines.append("# TYPE {} histogram".format(name))
+        bounds = buckets.get(name, time_buckets)
+        for (n, labels), h in sorted(histos.items()):
+            if n != name:
+                continue
+            for bound, value in zip(bounds, h):
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", str(bound)),)), value))
+            lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", "+Inf"),)), h[-1]))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), h[-2]))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), h[-1]))
+    return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+                                           .replace("\n", "\\n")) for k, v in labels) + "}"
+
+# Whether request may see the metrics: from this host, or with the token
+def allowed(request):
+    if metrics_token:
+        return hmac.compare_digest(request.headers.get("Authorization", ""),
+                                   "Bearer " + metrics_token)
+    return (request.remote_addr in ("127.0.0.1", "::1")
+            and not request.headers.get("X-Forwarded-For"))
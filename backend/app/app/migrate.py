@@ -0,0 +1,78 @@
+from main import db
+from models import count_answers_sql
+
+# db.create_all() only creates missing tables, so schema changes to existing
+# databases go here. Each migration runs once and is recorded by name.
+migrations = [
+    ("borderling-dob", [
+        "ALTER TABLE borderling ADD COLUMN dob DATE",
+        "CREATE INDEX ix_borderling_dob ON borderling (dob)",
+        '''UPDATE borderling SET dob = to_date(answer.text, 'YYYY-MM-DD')
+           FROM answer JOIN question ON question.answer_id = answer.id
+           WHERE question.tag = 'DOB' AND answer.borderling_id = borderling.id
+             AND answer.text ~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}$' ''']),
+    ("voucher-borderling-index", [
+        "CREATE INDEX ix_voucher_borderling_id ON voucher (borderling_id)"]),
+    ("questions-version", [
+        "ALTER TABLE lottery ADD COLUMN questions_version INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX ix_answer_borderling_id ON answer (borderling_id)"]),
+    ("voucher-reclaim", [
+        "ALTER TABLE voucher ADD COLUMN reclaimed TIMESTAMP",
+        "DROP INDEX ix_voucher_borderling_id",
+        "CREATE INDEX ix_voucher_borderling_expires ON voucher (borderling_id, expires)",
+        """CREATE INDEX ix_voucher_unreclaimed ON voucher (expires)
+           WHERE reclaimed IS NULL AND "order" IS NULL"""]),
+    # Answers used to be found through question.answer_id, which only ever
+    # pointed at the latest answer to each question. Answers no question
+    # points at can't be attributed, answer-orphans moves them out.
+    ("answer-question-key", [
+        "ALTER TABLE answer ADD COLUMN question_id INTEGER REFERENCES question (id)",
+        "UPDATE answer SET question_id = question.id FROM question WHERE question.answer_id = answer.id",
+        "ALTER TABLE question DROP COLUMN answer_id",
+        """ALTER TABLE answer ALTER COLUMN selections TYPE INTEGER[]
+           USING string_to_array(NULLIF(selections, ''), ',')::INTEGER[]""",
+        "DROP INDEX ix_answer_borderling_id",
+        """ALTER TABLE answer ADD CONSTRAINT uq_answer_borderling_question
+           UNIQUE (borderling_id, question_id)""",
+        "CREATE INDEX ix_answer_selections ON answer USING gin (selections)"]),
+    # Kept in answer_orphan rather than deleted, in case someone asks
+    ("answer-orphans", [
+        """CREATE TABLE answer_orphan AS SELECT * FROM answer
+           WHERE question_id IS NULL OR borderling_id IS NULL""",
+        "DELETE FROM answer WHERE question_id IS NULL OR borderling_id IS NULL",
+        "ALTER TABLE answer ALTER COLUMN question_id SET NOT NULL",
+        "ALTER TABLE answer ALTER COLUMN borderling_id SET NOT NULL"]),
+    ("voucher-pool", [
+        "ALTER TABLE voucher ADD COLUMN pretix_id INTEGER",
+        "CREATE INDEX ix_voucher_pool ON voucher (id) WHERE borderling_id IS NULL"]),
+    # The table itself comes from create_all()
+    ("answer-count", [count_answers_sql]),
+    ("voucher-version", [
+        "ALTER TABLE voucher ADD COLUMN version INTEGER NOT NULL DEFAULT 0"]),
+    ("voucher-reoffered", [
+        "ALTER TABLE voucher ADD COLUMN reoffered TIMESTAMP",
+        """CREATE INDEX ix_voucher_unoffered ON voucher (reclaimed)
+           WHERE reclaimed IS NOT NULL AND reoffered IS NULL"""]),
+]
+
+def migrate():
+    fresh = not db.engine.has_table("lottery")
+    db.create_all()
+    db.session.execute('''CREATE TABLE IF NOT EXISTS schema_migration (
+                            name VARCHAR(200) PRIMARY KEY,
+                            applied TIMESTAMP NOT NULL DEFAULT now())''')
+    applied = { n for (n,) in db.session.execute("SELECT name FROM schema_migration") }
+    for name, statements in migrations:
+        if name in applied:
+            continue
+        # A fresh schema from create_all() is already up to date
+        if not fresh:
+            print("Migrating: {}".format(name))
+            for statement in statements:
+                db.session.execute(statement)
+        db.session.execute("INSERT INTO schema_migration (name) VALUES (:name)",
+                           { "name": name })
+        db.session.commit()
+
+if __name__ == '__main__':
+    migrate()
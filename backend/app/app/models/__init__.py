@@ -1,47 +1,52 @@
 
-from datetime import datetime, timedelta
-from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql.expression import func
-from main import app, db, get_lottery, host, org, event
-
-def get_or_create(model, **kwargs):
-    try:
-        return db.session.query(model).filter_by(**kwargs).one()
-    except NoResultFound:
-        created = model(**kwargs)
-        try: # This catches a some things it shouldn't, like an out of sync schema
-            app.logger.info("Creating: {}".format(created))
-            db.session.add(created)
-            db.session.commit()
-            return created
-        except IntegrityError:
-            app.logger.info("Integrity error {}".format(created))
-            db.session.rollback()
-            return db.session.query(model).filter_by(**kwargs).one()
-
-
-
-class Lottery(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    questionsets = db.relationship('Questionset', backref='Lottery', lazy = True)
-    borderlings = db.relationship('Borderling', backref='Lottery', lazy = True)
-    registration_start = db.Column(db.DateTime)
-    registration_end = db.Column(db.DateTime)
-    lottery_start = db.Column(db.DateTime)
-    lottery_end = db.Column(db.DateTime)
-    transfer_start = db.Column(db.DateTime)
-    transfer_end = db.Column(db.DateTime)
-    fcfs_voucher = db.Column(db.String(500))
-    child_voucher = db.Column(db.String(500))
-    child_item = db.Column(db.Integer)
-    ticket_item = db.Column(db.Integer)
-    pretix_event_url = db.Column(db.String(500))
-    message = db.Column(db.String(5000))
-
-    def __repr__(self):
-        return '<Lottery %r>' % self.id
-
+from datetime import datetime, timedelta, timezone
+import random
+import sqlalchemy.event
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.expression import func, or_
+from sqlalchemy.dialects.postgresql import insert, ARRAY
+import json
+from main import log, db, get_lottery, invalidate_lottery, host, org, event
+import audit
+
+# Session level advisory lock on a connection of its own, held until that
+# connection is closed. Returns the connection, or None if someone else holds it.
+def advisory_lock(name):
+    conn = db.engine.connect()
+    if conn.execute(db.text("SELECT pg_try_advisory_lock(hashtext(:name))"), name=name).scalar():
+        return conn
+    conn.close()
+    return None
+
+# Borderlings are created on first sight, without a SELECT/INSERT/IntegrityError
+# dance when two requests race
+def get_borderling(email):
+    u = Borderling.query.filter(Borderling.email == email).first()
+    if not u:
+        db.session.execute(insert(Borderling.__table__).values(email = email, admin = False)
+                           .on_conflict_do_nothing(index_elements = ["email"]))
+        db.session.commit()
+        u = Borderling.query.filter(Borderling.email == email).one()
+    audit.identify(u.id)
+    return u
+
+# Create the borderling or move them into the lottery in one statement.
+# Returns True if this registered them, False if they already were.
+def register(email, lottery):
+    table = Borderling.__table__
+    stmt = insert(table).values(email = email, lottery_id = lottery.id, admin = False)
+    stmt = stmt.on_conflict_do_update(index_elements = ["email"],
+                                      set_ = { "lottery_id": lottery.id },
+                                      where = table.c.lottery_id.is_distinct_from(lottery.id))
+    return db.session.execute(stmt.returning(table.c.id)).first() is not None
+
+# Anyone born after this date counts as a child
+def child_cutoff():
+    return (datetime.utcnow() - timedelta(days = 13*365)).date()
+
+
+# Rules shared by the lottery model and the snapshots cached by get_lottery()
+class LotteryRules(object):
     def transferAllowed(self):
         return self.transfer_start < datetime.utcnow() and self.transfer_end > datetime.utcnow()
 
@@ -55,10 +60,14 @@ class Lottery(db.Model):
     def isFCFS(self):
         return self.fcfs_voucher and self.lottery_end < datetime.utcnow()
 
-    def get_random_borderling(self):
-        return Borderling.query.filter(Borderling.lottery_id == self.id,
-                                       ~Borderling.vouchers.any() ).order_by(
-                                           func.random()).first()
+    # Every adult registered without vouchers, in random order. The ids are
+    # loaded once and shuffled here instead of an ORDER BY random() per winner
+    def draw(self):
+        ids = [ i for (i,) in db.session.query(Borderling.id).filter(
+            Borderling.lottery_id == self.id, ~Borderling.vouchers.any(),
+            or_(Borderling.dob == None, Borderling.dob <= child_cutoff())) ]
+        random.SystemRandom().shuffle(ids)
+        return ids
 
     def to_dict(self):
         return { "can_register": self.registrationAllowed(),
@@ -75,7 +84,46 @@ class Lottery(db.Model):
                  "registration_start": self.registration_start,
                  "registration_end": self.registration_end,
                  "time": datetime.utcnow(),
-                 "questions": [ qs.id for qs in self.questionsets ]}
+                 "questions": list(self.questionset_ids) }
+
+class Lottery(db.Model, LotteryRules):
+    id = db.Column(db.Integer, primary_key=True)
+    questionsets = db.relationship('Questionset', backref='Lottery', lazy = True)
+    borderlings = db.relationship('Borderling', backref='Lottery', lazy = True)
+    registration_start = db.Column(db.DateTime)
+    registration_end = db.Column(db.DateTime)
+    lottery_start = db.Column(db.DateTime)
+    lottery_end = db.Column(db.DateTime)
+    transfer_start = db.Column(db.DateTime)
+    transfer_end = db.Column(db.DateTime)
+    fcfs_voucher = db.Column(db.String(500))
+    child_voucher = db.Column(db.String(500))
+    child_item = db.Column(db.Integer)
+    ticket_item = db.Column(db.Integer)
+    pretix_event_url = db.Column(db.String(500))
+    message = db.Column(db.String(5000))
+    # Bumped whenever question sets, questions or options change
+    questions_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    def __repr__(self):
+        return '<Lottery %r>' % self.id
+
+    @property
+    def questionset_ids(self):
+        return [ qs.id for qs in self.questionsets ]
+
+# Read-only copy of the lottery row, safe to keep around between requests
+class LotterySnapshot(LotteryRules):
+    def __init__(self, lottery):
+        for c in Lottery.__table__.columns:
+            object.__setattr__(self, c.key, getattr(lottery, c.key))
+        object.__setattr__(self, "questionset_ids", tuple(lottery.questionset_ids))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Lottery snapshots are read-only")
+
+    def __repr__(self):
+        return '<LotterySnapshot %r>' % self.id
 
 class Borderling(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -85,26 +133,32 @@ class Borderling(db.Model):
     vouchers = db.relationship('Voucher', backref='Borderling', lazy = True)
     answers = db.relationship('Answer', backref='Borderling', lazy = True)
     admin = db.Column(db.Boolean, default=False)
+    # Parsed from the DOB question whenever it's answered
+    dob = db.Column(db.Date, index=True)
 
     def __repr__(self):
         return '<Borderling %r>' % self.email
 
-    def isChild(self):
-        q = Question.query.filter(Question.tag == "DOB").first()
-        if not q:
-            return False
-        a = Answer.query.filter(Answer.borderling_id == self.id,
-                                Answer.question.any(Question.id == q.id)).first()
+    def set_dob(self, text):
         try:
-            dob = datetime.strptime(a.text, "%Y-%m-%d") # TODO
-        except:
-            return False
-        return dob > datetime.utcnow()-timedelta(days = 13*365)
+            self.dob = datetime.strptime(text, "%Y-%m-%d").date() # TODO
+        except (TypeError, ValueError):
+            self.dob = None
+
+    def isChild(self):
+        return bool(self.dob) and self.dob > child_cutoff()
 
-    def getVouchers(self):
-        lottery_ = get_lottery()
+    # All vouchers, paid ones first, in a single indexed query
+    def all_vouchers(self):
+        return Voucher.query.filter(Voucher.borderling_id == self.id).order_by(
+            Voucher.order, Voucher.primary.desc(), Voucher.id.desc()).all()
+
+    def getVouchers(self, vouchers=None):
+        if vouchers is None:
+            vouchers = self.all_vouchers()
+        now = datetime.utcnow()
 #        vouchers = [ v.to_dict() for v in self.vouchers ]
-        return [ v.to_dict() for v in Voucher.query.filter(Voucher.borderling_id == self.id, Voucher.expires > datetime.utcnow()).order_by(Voucher.order, Voucher.primary.desc(),Voucher.id.desc()).all() ]
+        return [ v.to_dict() for v in vouchers if v.expires and v.expires > now ]
 #        if vouchers:
 #            return vouchers
 #        else:
@@ -118,26 +172,34 @@ class Borderling(db.Model):
 #                return []
 
     def isRegistered(self, lottery):
-        return self in get_lottery().borderlings
+        return self.lottery_id == lottery.id
 
     def pretix_name(self):
         return "" # TODO realname and DOB
 
+    # Everything the registration page needs from one voucher query, so
+    # this stays cheap regardless of how many have registered
     def to_dict(self, lottery):
-        tickets = Voucher.query.filter(Voucher.borderling_id == self.id,
-                                       Voucher.order != None).first()
+        vouchers = self.all_vouchers()
+        tickets = next((v for v in vouchers if v.order), None)
         return { "registered": self.isRegistered(lottery),
                  "tickets": tickets and tickets.ticket_dict(),
                  "email": self.email,
                  "child_voucher": self.isChild() and lottery.child_voucher,
-                 "vouchers": self.getVouchers() }
+                 "vouchers": self.getVouchers(vouchers) }
 
+# One row per borderling and question. Selected option ids of multiple choice
+# questions are kept in an array, with a GIN index for counting them.
 class Answer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String(5000), unique=False, nullable=True)
-    borderling_id = db.Column(db.Integer, db.ForeignKey("borderling.id"))
-    question = db.relationship('Question', backref='Answer', lazy = True)
-    selections = db.Column(db.String(5000), unique=False, nullable=True)
+    borderling_id = db.Column(db.Integer, db.ForeignKey("borderling.id"), nullable=False)
+    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), nullable=False)
+    question = db.relationship('Question', backref='answers', lazy = True)
+    selections = db.Column(ARRAY(db.Integer), unique=False, nullable=True)
+    __table_args__ = (db.UniqueConstraint("borderling_id", "question_id",
+                                          name="uq_answer_borderling_question"),
+                      db.Index("ix_answer_selections", "selections", postgresql_using="gin"))
 
     def __repr__(self):
         return '<Answer: %r>' % self.text
@@ -148,47 +210,47 @@ class Question(db.Model):
     text = db.Column(db.String(5000), unique=False, nullable=True)
     tooltip = db.Column(db.String(5000), unique=False, nullable=True)
     type = db.Column(db.String(100), unique=False, nullable=True)
-    answer_id = db.Column(db.Integer, db.ForeignKey("answer.id"))
     options = db.relationship('QuestionOption', backref='Question', lazy = True)
     tag = db.Column(db.String(100), unique=False, nullable=True)
 
     def __repr__(self):
         return '<Question: %r>' % self.text
 
-    def get_selections(self, borderling):
-        a = Answer.query.filter(Answer.borderling_id == borderling.id,
-                                Answer.id == self.answer_id).first()
-        if a and a.selections:
-            return list(map(int, a.selections.split(",")))
-        else:
-            return []
+    def get_answer_row(self, borderling):
+        return Answer.query.filter(Answer.borderling_id == borderling.id,
+                                   Answer.question_id == self.id).first()
 
+    def get_selections(self, borderling):
+        a = self.get_answer_row(borderling)
+        return (a and a.selections) or []
 
     def get_answer(self, borderling):
-        a = Answer.query.filter(Answer.borderling_id == borderling.id,
-                                Answer.id == self.answer_id).first()
+        a = self.get_answer_row(borderling)
         if a:
             return a.text
         else:
             return ""
 
     def answer(self, u, v):
-        prev = db.session.query(Answer).filter(Answer.id == self.answer_id, Answer.borderling_id == u.id).first()
-        if type(v) != list:
-            if prev:
-                app.logger.info("User {} question {}: Replacing {} with {}".format(u, prev, prev.text, v))
-                prev.text = v
-            else:
-                db.session.add(Answer(question = [self], borderling_id = u.id, text = v))
-        else:
-            v = ",".join(v)
-            prev = db.session.query(Answer).filter(Answer.id == self.answer_id, Answer.borderling_id == u.id).first()
-            if prev:
-                app.logger.info("User {}: Replacing {} with {}".format(u.id, prev.text, v))
-                prev.selections = v
-            else:
-                db.session.add(Answer(question = [self], borderling_id = u.id, selections = v))
-        db.session.commit()
+        error = answer_questions(u, { self.id: v }, [self.set_id])
+        if error:
+            raise ValueError(error)
+
+    # Normalized answer value, raises ValueError if it doesn't fit the question
+    def clean_answer(self, v):
+        if type(v) == list:
+            try:
+                selections = [ int(o) for o in v ]
+            except (TypeError, ValueError):
+                raise ValueError("Unknown option for question {}".format(self.id))
+            if not set(selections) <= { o.id for o in self.options }:
+                raise ValueError("Unknown option for question {}".format(self.id))
+            return selections
+        if v is None:
+            return ""
+        if type(v) not in (str, int, float) or len(str(v)) > 5000:
+            raise ValueError("Invalid answer to question {}".format(self.id))
+        return str(v)
 
     def to_dict(self, borderling=None):
         return { "id": self.id,
@@ -231,6 +293,392 @@ class Questionset(db.Model):
                  "priority": self.priority,
                  "questions": [ q.to_dict(borderling) for q in self.questions ] }
 
+# Validate and store a batch of answers, {question id: value}, limited to the
+# given question sets. The questions are loaded in one query and the answers
+# upserted in one statement and one commit. Returns an error message, or None
+# if all answers were stored.
+def answer_questions(u, answers, set_ids):
+    try:
+        answers = { int(k): v for k, v in answers.items() }
+    except (AttributeError, TypeError, ValueError):
+        return "Malformed answers"
+    if not answers:
+        return None
+    questions = Question.query.options(joinedload(Question.options)).filter(
+        Question.id.in_(answers), Question.set_id.in_(set_ids)).all()
+    if len(questions) != len(answers):
+        return "Unknown question"
+    try:
+        cleaned = { q.id: q.clean_answer(answers[q.id]) for q in questions }
+    except (TypeError, ValueError) as e:
+        return str(e)
+    # Holding the borderling's row makes their concurrent submissions take
+    # turns, so the counters see each one's previous answers
+    db.session.query(Borderling.id).filter(Borderling.id == u.id).with_for_update().first()
+    previous = { qid: selections for qid, selections in db.session.query(
+        Answer.question_id, Answer.selections).filter(Answer.borderling_id == u.id,
+                                                      Answer.question_id.in_(cleaned)) }
+    count_answers(questions, previous, cleaned)
+    rows = []
+    for q in questions:
+        v = cleaned[q.id]
+        if q.tag == "DOB":
+            u.set_dob(v)
+        rows.append({ "borderling_id": u.id, "question_id": q.id,
+                      "text": None if type(v) == list else v,
+                      "selections": v if type(v) == list else None })
+    stmt = insert(Answer.__table__).values(rows)
+    db.session.execute(stmt.on_conflict_do_update(
+        constraint = "uq_answer_borderling_question",
+        set_ = { "text": stmt.excluded.text, "selections": stmt.excluded.selections }))
+    db.session.commit()
+    log.info("User {} answered {}".format(u.id, sorted(cleaned)))
+    return None
+
+# Running totals of answers for the stats, per lottery and question. option_id
+# 0 counts everyone who answered the question, the others how many picked
+# that option.
+class AnswerCount(db.Model):
+    lottery_id = db.Column(db.Integer, db.ForeignKey("lottery.id"), primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), primary_key=True)
+    option_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<AnswerCount: {} {} {}>'.format(self.question_id, self.option_id, self.count)
+
+# Moves the counters by the difference between a borderling's previous
+# answers, {question id: selections}, and the cleaned new ones. Rows are
+# upserted in key order so concurrent submissions lock them in the same order.
+def count_answers(questions, previous, cleaned):
+    lotteries = dict(db.session.query(Questionset.id, Questionset.lottery_id).filter(
+        Questionset.id.in_({ q.set_id for q in questions })))
+    deltas = {}
+    for q in questions:
+        lottery_id = lotteries.get(q.set_id)
+        if lottery_id is None:
+            continue
+        new = set(cleaned[q.id]) if type(cleaned[q.id]) == list else set()
+        old = set(previous.get(q.id) or [])
+        if q.id not in previous:
+            deltas[(lottery_id, q.id, 0)] = 1
+        for option, delta in [ (o, 1) for o in new - old ] + [ (o, -1) for o in old - new ]:
+            deltas[(lottery_id, q.id, option)] = delta
+    if not deltas:
+        return
+    table = AnswerCount.__table__
+    stmt = insert(table).values([ { "lottery_id": l, "question_id": q, "option_id": o, "count": d }
+                                  for (l, q, o), d in sorted(deltas.items()) ])
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements = ["lottery_id", "question_id", "option_id"],
+        set_ = { "count": table.c.count + stmt.excluded.count }))
+
+# Rebuilds the counters from the answer table, for answers written around
+# answer_questions()
+count_answers_sql = '''
+    INSERT INTO answer_count (lottery_id, question_id, option_id, count)
+    SELECT questionset.lottery_id, answer.question_id, 0, count(*)
+      FROM answer JOIN question ON question.id = answer.question_id
+                  JOIN questionset ON questionset.id = question.set_id
+     WHERE questionset.lottery_id IS NOT NULL
+     GROUP BY questionset.lottery_id, answer.question_id
+    UNION ALL
+    SELECT questionset.lottery_id, answer.question_id, selected.option_id, count(DISTINCT answer.id)
+      FROM answer JOIN question ON question.id = answer.question_id
+                  JOIN questionset ON questionset.id = question.set_id,
+           unnest(answer.selections) AS selected (option_id)
+     WHERE questionset.lottery_id IS NOT NULL
+     GROUP BY questionset.lottery_id, answer.question_id, selected.option_id'''
+
+def recount_answers():
+    db.session.execute("LOCK TABLE answer_count")
+    db.session.execute("DELETE FROM answer_count")
+    db.session.execute(count_answers_sql)
+    db.session.commit()
+
+# Answer stats for the lottery's questions from the counters alone
+def answer_stats(lottery):
+    counts = { (q, o): c for q, o, c in db.session.query(
+        AnswerCount.question_id, AnswerCount.option_id, AnswerCount.count).filter(
+            AnswerCount.lottery_id == lottery.id) }
+    stats = []
+    for qs_id in lottery.questionset_ids:
+        skeleton = questionset_skeleton(qs_id, lottery.questions_version)
+        for q in skeleton and skeleton["questions"] or []:
+            stats.append({ "id": q["id"], "question": q["question"],
+                           "answered": counts.get((q["id"], 0), 0),
+                           "options": [ { "id": o["id"], "text": o["text"],
+                                          "count": counts.get((q["id"], o["id"]), 0) }
+                                        for o in q["options"] ] })
+    return stats
+
+# Marks expired, unpaid vouchers as reclaimed in one statement and returns how
+# many there were. Pretix stops blocking quota for them once they're past
+# valid_until, so that's the capacity the next draw round can give away.
+def reclaim_expired_vouchers():
+    now = datetime.utcnow()
+    freed = Voucher.query.filter(Voucher.reclaimed == None, Voucher.order == None,
+                                 Voucher.expires < now).update(
+                                     { Voucher.reclaimed: now, Voucher.version: Voucher.version + 1 },
+                                     synchronize_session=False)
+    db.session.commit()
+    return freed
+
+# Reclaimed vouchers whose quota no reclaim round has given away yet. It's
+# counted from the table rather than passed along, so capacity a round
+# couldn't use (the lottery wasn't running, too few were eligible, Pretix
+# failed) is still there for the next one.
+def unoffered_reclaimed():
+    return Voucher.query.filter(Voucher.reclaimed != None, Voucher.reoffered == None)
+
+def mark_reoffered(count):
+    oldest = db.session.query(Voucher.id).filter(
+        Voucher.reclaimed != None, Voucher.reoffered == None).order_by(
+            Voucher.reclaimed, Voucher.id).limit(count)
+    marked = Voucher.query.filter(Voucher.id.in_(oldest)).update(
+        { Voucher.reoffered: datetime.utcnow(), Voucher.version: Voucher.version + 1 },
+        synchronize_session=False)
+    db.session.commit()
+    return marked
+
+# Outgoing mail, queued by lottomail and sent by mailer.py
+class Mail(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(500), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    next_attempt = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.DateTime)
+    error = db.Column(db.String(5000))
+    __table_args__ = (db.Index("ix_mail_pending", "next_attempt",
+                               postgresql_where=db.text("sent IS NULL")),)
+
+    def __repr__(self):
+        return '<Mail %r to %r>' % (self.id, self.recipient)
+
+# Append-only record of requests and voucher changes, written by audit.py
+class AuditLog(db.Model):
+    id = db.Column(db.BigInteger, primary_key=True)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    action = db.Column(db.String(200), nullable=False)
+    borderling_id = db.Column(db.Integer, index=True)
+    # The other party of transfers and gifts
+    target_id = db.Column(db.Integer, index=True)
+    voucher_id = db.Column(db.Integer, index=True)
+    ip = db.Column(db.String(100))
+    method = db.Column(db.String(10))
+    path = db.Column(db.String(1000))
+    status = db.Column(db.Integer)
+    detail = db.Column(db.Text)
+
+    def __repr__(self):
+        return '<AuditLog: {} {}>'.format(self.action, self.created)
+
+# Notifications received from Pretix, processed in order by webhooks.py
+class PretixNotification(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    notification_id = db.Column(db.Integer, unique=True)
+    action = db.Column(db.String(200))
+    code = db.Column(db.String(100))
+    payload = db.Column(db.Text, nullable=False)
+    received = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    next_attempt = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.DateTime)
+    error = db.Column(db.String(5000))
+    __table_args__ = (db.Index("ix_pretix_notification_pending", "id",
+                               postgresql_where=db.text("processed IS NULL")),)
+
+    def __repr__(self):
+        return '<PretixNotification %r %r>' % (self.notification_id, self.action)
+
+    # Pretix retries slow or failed deliveries, so repeats are dropped here
+    @staticmethod
+    def store(d):
+        now = datetime.utcnow()
+        db.session.execute(insert(PretixNotification.__table__).values(
+            notification_id = d.get('notification_id'),
+            action = d.get('action'),
+            code = d.get('code'),
+            payload = json.dumps(d),
+            received = now,
+            next_attempt = now,
+            attempts = 0).on_conflict_do_nothing(index_elements=["notification_id"]))
+        db.session.commit()
+
+    def data(self):
+        return json.loads(self.payload)
+
+# Pretix' timestamps as naive UTC, like ours
+def pretix_time(text):
+    if not text:
+        return None
+    t = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    return t.astimezone(timezone.utc).replace(tzinfo=None) if t.tzinfo else t
+
+# Upsert rows into one of the mirror tables below, not committed
+def store_mirrored(model, rows):
+    if not rows:
+        return
+    table = model.__table__
+    key = [ c.name for c in table.primary_key ]
+    stmt = insert(table).values(rows)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements = key,
+        set_ = { c.name: stmt.excluded[c.name] for c in table.columns if c.name not in key }))
+
+# Local copies of Pretix' orders, vouchers and quotas, kept up to date by
+# sync.py and the webhook worker
+class PretixOrder(db.Model):
+    code = db.Column(db.String(100), primary_key=True)
+    status = db.Column(db.String(10))
+    secret = db.Column(db.String(1000))
+    email = db.Column(db.String(500))
+    # Pretix ids of the vouchers its positions were bought with
+    voucher_ids = db.Column(ARRAY(db.Integer))
+    last_modified = db.Column(db.DateTime, index=True)
+    synced = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<PretixOrder %r %r>' % (self.code, self.status)
+
+    def isPaid(self):
+        return self.status == "p"
+
+    # Joins our vouchers used in the orders of query to it, found by the Pretix
+    # id pool.py recorded or by code through the voucher mirror. query has to
+    # select from PretixOrder.
+    @staticmethod
+    def join_vouchers(query):
+        return query.outerjoin(PretixVoucher, PretixOrder.voucher_ids.any(PretixVoucher.id)).join(
+            Voucher, or_(PretixOrder.voucher_ids.any(Voucher.pretix_id),
+                         Voucher.code == PretixVoucher.code))
+
+    # The voucher a payment of this order is for: the first of ours in it
+    # that isn't paid yet. sync.reconcile looks for the same ones.
+    def unpaid_voucher(self):
+        return PretixOrder.join_vouchers(db.session.query(Voucher).select_from(PretixOrder)).filter(
+            PretixOrder.code == self.code, Voucher.order == None).order_by(Voucher.id).first()
+
+    def paid_voucher(self):
+        return Voucher.query.filter(Voucher.order == self.code).first()
+
+    @staticmethod
+    def row(d):
+        return { "code": d["code"], "status": d.get("status"), "secret": d.get("secret"),
+                 "email": d.get("email"),
+                 "voucher_ids": [ p["voucher"] for p in d.get("positions") or [] if p.get("voucher") ],
+                 "last_modified": pretix_time(d.get("last_modified")),
+                 "synced": datetime.utcnow() }
+
+class PretixVoucher(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    code = db.Column(db.String(1000), index=True)
+    valid_until = db.Column(db.DateTime)
+    max_usages = db.Column(db.Integer)
+    redeemed = db.Column(db.Integer)
+    synced = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<PretixVoucher %r %r>' % (self.id, self.code)
+
+    @staticmethod
+    def row(d):
+        return { "id": d["id"], "code": d["code"], "valid_until": pretix_time(d.get("valid_until")),
+                 "max_usages": d.get("max_usages"), "redeemed": d.get("redeemed"),
+                 "synced": datetime.utcnow() }
+
+class PretixQuota(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(200))
+    size = db.Column(db.Integer)
+    items = db.Column(ARRAY(db.Integer))
+    available = db.Column(db.Boolean)
+    # None is unlimited
+    available_number = db.Column(db.Integer)
+    synced = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<PretixQuota %r %r>' % (self.name, self.available_number)
+
+    @staticmethod
+    def row(d, availability):
+        return { "id": d["id"], "name": d.get("name"), "size": d.get("size"),
+                 "items": d.get("items") or [], "available": availability.get("available"),
+                 "available_number": availability.get("available_number"),
+                 "synced": datetime.utcnow() }
+
+    # Tickets of the item left according to a sync newer than max_age, None
+    # if unknown or unlimited
+    @staticmethod
+    def remaining(item, max_age):
+        quotas = PretixQuota.query.filter(PretixQuota.items.any(item),
+                                          PretixQuota.synced > datetime.utcnow() - max_age).all()
+        limited = [ q for q in quotas if q.available_number is not None ]
+        if not limited:
+            return None
+        return min(q.available_number if q.available else 0 for q in limited)
+
+# Progress reported by long-running workers like scheduler.py, one row each
+class WorkerStatus(db.Model):
+    name = db.Column(db.String(100), primary_key=True)
+    updated = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    status = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return '<WorkerStatus %r>' % self.name
+
+    @staticmethod
+    def save(name, status):
+        table = WorkerStatus.__table__
+        stmt = insert(table).values(name = name, updated = datetime.utcnow(),
+                                    status = json.dumps(status, default=str))
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements = ["name"],
+            set_ = { "updated": stmt.excluded.updated, "status": stmt.excluded.status }))
+        db.session.commit()
+
+    def to_dict(self):
+        return dict(json.loads(self.status), updated = self.updated)
+
+# The structure of question sets only changes when admins edit them, so it's
+# cached per process and thrown away when the lottery's questions_version moves
+_skeletons = {}
+
+def questionset_skeleton(qs_id, version):
+    cached = _skeletons.get(qs_id)
+    if cached and cached[0] == version:
+        return cached[1]
+    qs = Questionset.query.options(
+        joinedload(Questionset.questions).joinedload(Question.options)).filter(
+            Questionset.id == qs_id).first()
+    skeleton = qs and qs.to_dict()
+    _skeletons[qs_id] = (version, skeleton)
+    return skeleton
+
+# A question set with the borderling's answers, all fetched in one query
+def answered_questionset(qs_id, borderling, version):
+    skeleton = questionset_skeleton(qs_id, version)
+    if not skeleton:
+        return None
+    answers = { qid: (text, selections) for qid, text, selections in
+                db.session.query(Answer.question_id, Answer.text, Answer.selections).filter(
+                    Answer.borderling_id == borderling.id,
+                    Answer.question_id.in_([ q["id"] for q in skeleton["questions"] ])) }
+    questions = []
+    for q in skeleton["questions"]:
+        text, selections = answers.get(q["id"], (None, None))
+        questions.append(dict(q, answer = text or q["answer"],
+                              selections = selections or []))
+    return dict(skeleton, questions = questions)
+
+def bump_questions_version(mapper, connection, target):
+    lottery = Lottery.__table__
+    connection.execute(lottery.update().values(questions_version = lottery.c.questions_version + 1))
+    _skeletons.clear()
+    invalidate_lottery()
+
 class Voucher(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(1000), unique=True, nullable=False)
@@ -240,6 +688,21 @@ class Voucher(db.Model):
     order = db.Column(db.String(1000), unique=True, nullable=True)
     secret = db.Column(db.String(1000), unique=True, nullable=True)
     primary = db.Column(db.Boolean, default = False)
+    # Set by reclaim_expired_vouchers once an unpaid voucher has expired
+    reclaimed = db.Column(db.DateTime)
+    # Set once a reclaim round has given the quota it held to a new winner
+    reoffered = db.Column(db.DateTime)
+    pretix_id = db.Column(db.Integer)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Vouchers without a borderling are the pool created by pool.py
+    __table_args__ = (db.Index("ix_voucher_borderling_expires", "borderling_id", "expires"),
+                      db.Index("ix_voucher_pool", "id",
+                               postgresql_where=db.text("borderling_id IS NULL")),
+                      db.Index("ix_voucher_unreclaimed", "expires",
+                               postgresql_where=db.text('reclaimed IS NULL AND "order" IS NULL')),
+                      db.Index("ix_voucher_unoffered", "reclaimed",
+                               postgresql_where=db.text("reclaimed IS NOT NULL AND reoffered IS NULL")))
+    __mapper_args__ = { "version_id_col": version }
 
     def __repr__(self):
         return '<Voucher: %r>' % self.code
@@ -257,41 +720,93 @@ class Voucher(db.Model):
             return True
         return False
 
+    # Every change bumps the version. The transitions below are single
+    # UPDATEs that only apply if the voucher is still as they saw it, and
+    # ORM flushes check it too (StaleDataError), so concurrent workers can't
+    # overwrite each other. Returns whether the update applied.
+    def change(self, conditions, **values):
+        table = Voucher.__table__
+        values["version"] = table.c.version + 1
+        result = db.session.execute(table.update().where(
+            db.and_(table.c.id == self.id, *conditions)).values(**values))
+        db.session.expire(self)
+        return result.rowcount == 1
+
+    def unchanged(self):
+        return Voucher.__table__.c.version == self.version
+
+    # Transfer to target. Returns None, or why it wasn't possible, which is
+    # voucher_changed if someone else got there first. Refusals change nothing
+    # and leave the rest of the caller's session alone.
     def transfer(self, origin, target):
-        # not checking if transfers are allowed here because it's used by
-        # gifting and webhooks
+        # /api/transfer checks the transfer window for every voucher, this
+        # only keeps primary vouchers to it for any other caller
         if origin.id != self.borderling_id:
-            app.logger.warn("Attempt to transfer ticket {} from {} to {}, but not owned by {}".format(self, origin, target, self.borderling_id))
-            return False
-        if self.primary and not get_lottery().transferAllowed:
-            app.logger.error("Attempt to transfer primary voucher: {}".format(self))
-            return False
-        if target.vouchers and target.vouchers[0].order:
-            app.logger.error("Attempt to transfer but target already has paid vouchers: {}".format(self))
+            log.warn("Attempt to transfer ticket {} from {} to {}, but not owned by {}".format(self, origin, target, self.borderling_id))
+            return "Not your voucher"
+        if self.primary and not get_lottery().transferAllowed():
+            log.error("Attempt to transfer primary voucher: {}".format(self))
+            return "Primary vouchers can't be transferred"
+        # Transfers to the same borderling take turns on their row, so each
+        # sees the vouchers the previous one gave them
+        db.session.query(Borderling.id).filter(Borderling.id == target.id).with_for_update().first()
+        held = Voucher.query.filter(Voucher.borderling_id == target.id, db.or_(
+            Voucher.order != None, Voucher.expires > datetime.utcnow())).order_by(
+                Voucher.order).first()
+        if held and held.order:
+            log.error("Attempt to transfer but target already has paid vouchers: {}".format(self))
+            return "They already have a ticket"
+        if held:
+            log.error("Attempt to transfer but target already has valid voucher: {}".format(self))
+            return "They already have a voucher"
+        if not self.move(origin, target):
+            return voucher_changed
+        return None
+
+    # With commit=False the move goes out with the caller's transaction
+    def move(self, origin, target, commit=True):
+        table = Voucher.__table__
+        if not self.change([ self.unchanged(), table.c.borderling_id == origin.id ],
+                           primary = True, borderling_id = target.id, gifted_to = None):
+            log.warn("Voucher {} changed before it could move from {} to {}".format(self, origin, target))
             return False
-        if target.vouchers and target.vouchers[0].expires > datetime.utcnow():
-            app.logger.error("Attempt to transfer but target already has valid voucher: {}".format(self))
-            return False
-        self.move(origin, target)
-        return True
-
-    def move(self, origin, target):
-        self.primary = True
-        self.borderling_id = target.id
-        self.gifted_to = None
-        db.session.commit()
-        app.logger.warn("Transfered ticket {} from {} to {}".format(self, origin, target))
+        audit.record_change("voucher.move", borderling_id=origin.id, target_id=target.id,
+                            voucher_id=self.id)
+        if commit:
+            db.session.commit()
+        log.warn("Transfered ticket {} from {} to {}".format(self, origin, target))
         return True
 
+    # Returns None, or why it wasn't possible, like transfer
     def gift_to(self, origin, target):
         if origin.id != self.borderling_id and not self.order:
-            app.logger.warn("gift_to: {} tried to gift ticket to {}, but voucher is either not paid for, or is not owned by source".format(origin, target))
-            return False
+            log.warn("gift_to: {} tried to gift ticket to {}, but voucher is either not paid for, or is not owned by source".format(origin, target))
+            return "Not your voucher"
         if Voucher.query.filter(Voucher.borderling_id == target.id, Voucher.order != None).first():
-            app.logger.warn("gift_to: {} tried to gift ticket to {} who already has one".format(origin, target))
-            # TODO return error text
-            return False
-        self.gifted_to = target.id
+            log.warn("gift_to: {} tried to gift ticket to {} who already has one".format(origin, target))
+            return "They already have a ticket"
+        theirs = Voucher.__table__.alias()
+        if not self.change([ self.unchanged(),
+                             ~db.exists().where(db.and_(theirs.c.borderling_id == target.id,
+                                                        theirs.c.order != None)) ],
+                           gifted_to = target.id):
+            return voucher_changed
+        audit.record_change("voucher.gift", borderling_id=origin.id, target_id=target.id,
+                            voucher_id=self.id)
         db.session.commit()
-        return True
-
+        return None
+
+    # Record the paying order. Repeated notifications for the same order are
+    # fine, another order for the same voucher isn't. Not committed.
+    def mark_paid(self, order, secret):
+        table = Voucher.__table__
+        return self.change([ db.or_(table.c.order == None, table.c.order == order) ],
+                           order = order, secret = secret)
+
+voucher_changed = "The voucher was changed by someone else, please try again"
+
+for model in (Questionset, Question, QuestionOption):
+    for e in ("after_insert", "after_update", "after_delete"):
+        sqlalchemy.event.listen(model, e, bump_questions_version)
+for e in ("after_insert", "after_update", "after_delete"):
+    sqlalchemy.event.listen(Lottery, e, lambda mapper, connection, target: invalidate_lottery())
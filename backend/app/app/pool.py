@@ -0,0 +1,9 @@
+from main import *
+import sys
+
+# Pre-create unassigned vouchers before the lottery opens, so the draw only
+# has to bind them: python pool.py 2000
+# Binding costs a PATCH per voucher, twice the requests of creating a pair on
+# the spot, so this only speeds up a draw if Pretix is much slower at
+# batch_create than at updating a voucher. Measure before using it.
+print("Created {} vouchers".format(pretix.provision_pool(int(sys.argv[1]))))
@@ -1,92 +1,334 @@
 import os
-from main import db, expiration_delta, host, org, event, item, app
+import time
+import threading
+from main import db, expiration_delta, host, pretix_url, org, event, item, vouchers_per_winner, draw_concurrency, log
 from models import *
 import requests
-import random
-import lottomail
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.exceptions import NewConnectionError
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+import metrics
 from datetime import datetime,timedelta
 
 pretix_token = os.getenv("PRETIX_TOKEN")
 
+# Talks to the Pretix API over a pooled keep-alive session. Idempotent
+# requests are retried with backoff, and every call is timed per endpoint.
+class PretixClient(object):
+    def __init__(self, base_url, token, timeout=(3.05, 10), retries=3, pool_size=10):
+        self.base_url = "{}/api/v1/organizers/{}/events/{}/".format(base_url.rstrip("/"), org, event)
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = "Token {}".format(token)
+        retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=0.3,
+                      status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False,
+                      method_whitelist=frozenset(["GET", "HEAD", "PUT", "PATCH", "DELETE"]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # name -> [calls, errors, total seconds, slowest]
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, error):
+        with self.lock:
+            s = self.stats.setdefault(name, [0, 0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += error
+            s[2] += seconds
+            s[3] = max(s[3], seconds)
+
+    def request(self, name, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.monotonic()
+        error = True
+        try:
+            # Paginated lists link to their next page with full URLs
+            url = path if path.startswith(("http://", "https://")) else self.base_url + path
+            r = self.session.request(method, url, **kwargs)
+            error = r.status_code >= 400
+            return r
+        finally:
+            seconds = time.monotonic() - start
+            self.record(name, seconds, error)
+            metrics.external("pretix", seconds)
+            log.debug("Pretix {} {} took {:.3f}s".format(method, path, seconds))
+
+    def get(self, name, path, **kwargs):
+        return self.request(name, "GET", path, **kwargs)
+
+    def post(self, name, path, **kwargs):
+        return self.request(name, "POST", path, **kwargs)
+
+client = PretixClient(pretix_url, pretix_token,
+                      timeout=(float(os.getenv("PRETIX_CONNECT_TIMEOUT") or 3.05),
+                               float(os.getenv("PRETIX_READ_TIMEOUT") or 10)),
+                      retries=int(os.getenv("PRETIX_RETRIES") or 3),
+                      pool_size=int(os.getenv("PRETIX_POOL_SIZE") or 10))
+
+code_alphabet = [ chr(c) for c in range(ord('A'), ord('Z')+1) ] + [ str(i) for i in range(1,9) ]
+pool_batch_size = int(os.getenv("VOUCHER_POOL_BATCH_SIZE") or 500)
+provision_attempts = int(os.getenv("PRETIX_PROVISION_ATTEMPTS") or 3)
+
+# Pretix is down or overloaded, as opposed to refusing the request
+class PretixUnavailable(Exception):
+    pass
+
 def generate_code():
-    return  "".join(random.sample([ chr(c) for c in range(ord('A'), ord('Z')+1) ]
-                                  + [ str(i) for i in range(1,9)], 25))
+    return "".join(secrets.choice(code_alphabet) for _ in range(25))
 
-def get_vouchers(borderling):
+# n fresh codes, none of them already in use
+def generate_codes(n):
+    codes = set()
+    while len(codes) < n:
+        fresh = { generate_code() for _ in range(n - len(codes)) }
+        taken = { c for (c,) in db.session.query(Voucher.code).filter(Voucher.code.in_(fresh)) }
+        codes |= fresh - taken
+    return list(codes)
+
+def voucher_body(code, valid_until):
+    return { "code": code,
+             "max_usages": 1,
+             "valid_until": str(valid_until),
+             "block_quota": "true",
+             "item": item,
+
+             "allow_ignore_quota": "false",
+             "price_mode": "none",
+             "value": "0",
+             "variation": None,
+             "quota": None,
+             "tag": "lottery",
+             "comment": "",
+             "subevent": None }
+
+# Give each borderling their vouchers, bound from the pre-created pool while it
+# lasts and created on the spot after that. The Pretix calls run on up to
+# draw_concurrency threads, each retried on its own, while all database work
+# stays on this thread. Returns the borderlings that got vouchers, in the
+# order given. Nothing is committed.
+def allocate_vouchers(borderlings):
     valid_until = datetime.now()+timedelta(**expiration_delta)
+    pool = Voucher.query.filter(Voucher.borderling_id == None).order_by(Voucher.id).limit(
+        len(borderlings) * vouchers_per_winner).with_for_update(skip_locked=True).all()
+    pooled = [ pool[i:i+vouchers_per_winner] for i in range(0, len(pool), vouchers_per_winner) ]
+    pooled = [ vs for vs in pooled if len(vs) == vouchers_per_winner ]
+    codes = generate_codes(max(0, len(borderlings) - len(pooled)) * vouchers_per_winner)
+    plans = []
+    for i in range(len(borderlings)):
+        if i < len(pooled):
+            plans.append((pooled[i], None))
+        else:
+            j = (i - len(pooled)) * vouchers_per_winner
+            plans.append((None, codes[j:j+vouchers_per_winner]))
+
+    with ThreadPoolExecutor(max_workers=draw_concurrency) as executor:
+        # A pooled winner's vouchers are activated side by side, so they take
+        # one round trip like the batch_create for a new pair
+        futures = [ [ executor.submit(provision, "activate", set_valid_until, v.pretix_id, valid_until)
+                      for v in vouchers ] if vouchers else
+                    [ executor.submit(create_vouchers_once, codes, valid_until) ]
+                    for vouchers, codes in plans ]
+        results = [ [ f.result() for f in fs ] for fs in futures ]
+        # Winners get all their pool vouchers or none. The vouchers of those
+        # who didn't are expired again, or any that were activated (or timed
+        # out halfway) would block quota while going back to the pool.
+        list(executor.map(expire_voucher, [ v.pretix_id for (vouchers, _), result in zip(plans, results)
+                                            if vouchers and not all(result) for v in vouchers ]))
 
-    r = requests.post("https://{}/api/v1/organizers/{}/events/{}/vouchers/batch_create/".format(host, org, event),
-                  headers = {
-                      "Authorization": "Token {}".format(pretix_token)
-                  },
-                  json = [
-                      {
-                          "code": generate_code(),
-                          "max_usages": 1,
-                          "valid_until": str(valid_until),
-                          "block_quota": "true",
-                          "item": item,
-
-                          "allow_ignore_quota": "false",
-                          "price_mode": "none",
-                          "value": "0",
-                          "variation": None,
-                          "quota": None,
-                          "tag": "lottery",
-                          "comment": "",
-                          "subevent": None
-                      },
-                      {
-                          "code": generate_code(),
-                          "max_usages": 1,
-                          "valid_until": str(valid_until),
-                          "block_quota": "true",
-                          "item": item,
-
-                          "allow_ignore_quota": "false",
-                          "price_mode": "none",
-                          "value": "0",
-                          "variation": None,
-                          "quota": None,
-                          "tag": "lottery",
-                          "comment": "",
-                          "subevent": None
-                      }
-                  ])
-
-    if r.status_code == 201:
+    allocated = []
+    for borderling, (vouchers, _), result in zip(borderlings, plans, results):
+        if not all(result):
+            log.error("Unable to allocate vouchers to {}".format(borderling))
+            continue
+        if vouchers is None:
+            vouchers = [ Voucher(code = v["code"], pretix_id = v.get("id")) for v in result[0] ]
+            db.session.add_all(vouchers)
         first = True
-        for v in r.json():
-            app.logger.info("Created voucher {}".format(v['code']))
-            db.session.add(Voucher(
-                borderling_id = borderling.id,
-                code = v["code"],
-                expires = valid_until,
-                primary = first
-            ))
+        for v in vouchers:
+            log.info("Allocated voucher {} to {}".format(v.code, borderling))
+            v.borderling_id = borderling.id
+            v.expires = valid_until
+            v.primary = first
             first = False
-        db.session.commit()
-        lottomail.voucher_allocated(borderling.email)
+        allocated.append(borderling)
+    return allocated
+
+# Runs on the worker threads, so Pretix only. Returns what f returns, or None
+# if Pretix refused or stayed unavailable.
+def provision(what, f, *args):
+    for attempt in range(1, provision_attempts + 1):
+        try:
+            return f(*args) or None
+        except (requests.RequestException, PretixUnavailable) as e:
+            log.warn("Pretix {} attempt {} failed: {}".format(what, attempt, e))
+            if attempt < provision_attempts:
+                time.sleep(0.5 * 2**attempt)
+    return None
+
+def check_response(r, expected, what):
+    if r.status_code == expected:
         return True
-    else:
-        print("Unable to create vouchers: {} {}".format(r.status_code, r.text))
-        return False
+    if r.status_code == 429 or r.status_code >= 500:
+        raise PretixUnavailable("{}: {} {}".format(what, r.status_code, r.text))
+    log.error("Unable to {}: {} {}".format(what, r.status_code, r.text))
+    return False
+
+# Create vouchers in Pretix, returns their Pretix representation or None
+def create_vouchers(codes, valid_until):
+    r = client.post("batch_create", "vouchers/batch_create/",
+                    json = [ voucher_body(code, valid_until) for code in codes ])
+    if check_response(r, 201, "create vouchers"):
+        return r.json()
+    return None
+
+# batch_create isn't idempotent, and a request that failed after it went out
+# may have created the vouchers anyway. So before trying again the codes are
+# looked up, and those Pretix has are kept instead of created twice. Returns
+# the vouchers, or None if Pretix refused or stayed unavailable, in which case
+# any that were created are expired again.
+def create_vouchers_once(codes, valid_until):
+    created = []
+    unsure = False
+    for attempt in range(1, provision_attempts + 1):
+        try:
+            if unsure:
+                found = find_vouchers(codes)
+                created += found
+                codes = [ c for c in codes if c not in { v["code"] for v in found } ]
+                unsure = False
+            if not codes:
+                return created
+            try:
+                result = create_vouchers(codes, valid_until)
+            except (requests.RequestException, PretixUnavailable) as e:
+                unsure = not never_sent(e)
+                raise
+            if result is not None:
+                return created + result
+            break
+        except (requests.RequestException, PretixUnavailable) as e:
+            log.warn("Pretix create attempt {} failed: {}".format(attempt, e))
+            if attempt < provision_attempts:
+                time.sleep(0.5 * 2**attempt)
+    if unsure:
+        try:
+            created += find_vouchers(codes)
+        except (requests.RequestException, PretixUnavailable) as e:
+            log.error("Vouchers {} may have been created for nobody: {}".format(codes, e))
+    for v in created:
+        expire_voucher(v["id"])
+    return None
+
+# Failures from before the request went out, so Pretix never saw it
+def never_sent(e):
+    reason = e.args and getattr(e.args[0], "reason", None)
+    return isinstance(e, requests.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+# The vouchers with these codes that exist in Pretix
+def find_vouchers(codes):
+    found = []
+    for code in codes:
+        r = client.get("find_voucher", "vouchers/", params = { "code": code })
+        if not check_response(r, 200, "look up voucher {}".format(code)):
+            raise PretixUnavailable("Unable to look up voucher {}".format(code))
+        found += r.json()["results"]
+    return found
+
+# Pretix has no bulk update for vouchers, so pool vouchers are activated and
+# expired one PATCH at a time
+def set_valid_until(pretix_id, valid_until, name="activate"):
+    r = client.request(name, "PATCH", "vouchers/{}/".format(pretix_id),
+                       json = { "valid_until": str(valid_until) })
+    return check_response(r, 200, "{} voucher {}".format(name, pretix_id))
+
+# Back to expired, as pool.py creates them, for vouchers nobody got
+def expire_voucher(pretix_id):
+    if provision("expire", set_valid_until, pretix_id, datetime.now(), "expire"):
+        return True
+    log.error("Voucher {} blocks quota for nobody until it expires".format(pretix_id))
+    return False
+
+# Pre-create count unassigned vouchers in Pretix, in large batches. They are
+# created already expired, so they neither block quota nor work until a draw
+# binds them to a winner and moves valid_until.
+def provision_pool(count):
+    created = 0
+    while created < count:
+        n = min(pool_batch_size, count - created)
+        try:
+            result = create_vouchers(generate_codes(n), datetime.now())
+        except (requests.RequestException, PretixUnavailable) as e:
+            log.error("Voucher pool: {}".format(e))
+            result = None
+        if result is None:
+            break
+        vouchers = [ Voucher(code = v["code"], pretix_id = v.get("id")) for v in result ]
+        db.session.add_all(vouchers)
+        db.session.commit()
+        created += len(vouchers)
+        log.info("Voucher pool: created {} of {}".format(created, count))
+    return created
+
+# The results of a Pretix list, a page at a time
+def pages(name, path, params=None):
+    while path:
+        r = client.get(name, path, params=params)
+        if not check_response(r, 200, "list {}".format(path)):
+            raise RuntimeError("Unable to list {}: {}".format(path, r.status_code))
+        data = r.json()
+        yield data["results"]
+        path, params = data.get("next"), None
+
+# The order from the local mirror, or fetched from Pretix and mirrored if it
+# isn't there or isn't paid yet, as the webhook can beat the sync to it.
+# Not committed.
+def order(code):
+    local = PretixOrder.query.get(code)
+    if local and local.isPaid():
+        return local
+    d = order_info(code)
+    if not d:
+        return None
+    store_mirrored(PretixOrder, [ PretixOrder.row(d) ])
+    if local:
+        db.session.expire(local)
+    return PretixOrder.query.get(code)
+
+# Makes sure the voucher mirror knows the order's vouchers that aren't ours
+# by id, so PretixOrder.join_vouchers can match them by code. Only asks
+# Pretix about ids the mirror doesn't know yet.
+def mirror_order_vouchers(order):
+    ids = order.voucher_ids or []
+    known = { i for (i,) in db.session.query(Voucher.pretix_id).filter(Voucher.pretix_id.in_(ids)) }
+    known |= { i for (i,) in db.session.query(PretixVoucher.id).filter(PretixVoucher.id.in_(ids)) }
+    for pretix_id in ids:
+        if pretix_id in known:
+            continue
+        d = voucher_info(pretix_id)
+        if not d:
+            raise RuntimeError("No voucher info for {}".format(pretix_id))
+        store_mirrored(PretixVoucher, [ PretixVoucher.row(d) ])
 
 def order_info(code):
-    r = requests.get("https://{}/api/v1/organizers/{}/events/{}/orders/{}/".format(host, org, event, code),
-                     headers = {
-                      "Authorization": "Token {}".format(pretix_token)
-                  })
+    try:
+        r = client.get("order_info", "orders/{}/".format(code))
+    except requests.RequestException as e:
+        log.warn("Error getting pretix order info: {}".format(e))
+        return None
     if r.status_code == 200:
         return r.json()
-    app.logger.warn("Error getting pretix order info: {} {}".format(r.status_code, r.text))
+    log.warn("Error getting pretix order info: {} {}".format(r.status_code, r.text))
     return None
 
 def voucher_info(vid):
-    r = requests.get("https://{}/api/v1/organizers/{}/events/{}/vouchers/{}/".format(host, org, event, vid),
-                     headers = {
-                      "Authorization": "Token {}".format(pretix_token)
-                  })
+    try:
+        r = client.get("voucher_info", "vouchers/{}/".format(vid))
+    except requests.RequestException as e:
+        log.warn("Error getting pretix voucher info: {}".format(e))
+        return None
     if r.status_code == 200:
         return r.json()
     # {
@@ -106,10 +348,10 @@ def voucher_info(vid):
     #   "comment": "",
     #   "subevent": null
     # }
-    app.logger.warn("Error getting pretix voucher info: {} {}".format(r.status_code, r.text))
+    log.warn("Error getting pretix voucher info: {} {}".format(r.status_code, r.text))
     return None
 
 
 def update_order_name(a, b):
-    app.logger.error("UNIMPLEMENTED update {} with {}".format(a, b))
+    log.error("UNIMPLEMENTED update {} with {}".format(a, b))
 
@@ -0,0 +1,89 @@
+from main import *
+import os
+import sys
+import time
+import signal
+import socket
+from datetime import datetime, timedelta
+
+# Stays up and runs a draw round every DRAW_INTERVAL seconds while the lottery
+# is running, instead of a cold start per cron tick. Each round first reclaims
+# expired invitations, then draws until Pretix runs out of quota. With
+# DRAW_RATE set, invitations go out at about that many per minute instead of
+# all at once. Only one scheduler (or cron.py) draws at a time, and progress
+# is kept in worker_status for /api/admin/draw.
+interval = float(os.getenv("DRAW_INTERVAL") or 60)
+rate = float(os.getenv("DRAW_RATE") or 0)
+
+# Invitations allowed so far at rate per minute. Allowance left unused is
+# only kept for one interval, so a stall doesn't end in a burst.
+class Pacer(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = 0.0
+        # The first round gets a full interval's worth
+        self.last = time.monotonic() - interval
+
+    def budget(self):
+        if not self.rate:
+            return None
+        now = time.monotonic()
+        self.allowance = min(self.allowance + (now - self.last) * self.rate / 60,
+                             max(1.0, self.rate * interval / 60))
+        self.last = now
+        return int(self.allowance)
+
+    def spend(self, n):
+        self.allowance = max(0.0, self.allowance - n)
+
+def run_round(pacer, progress):
+    lottery = get_lottery()
+    progress.update(round_started = datetime.utcnow(), state = "drawing")
+    progress.pop("error", None)
+    if not lottery or not lottery.lotteryRunning():
+        progress.update(state = "waiting for the lottery")
+        return
+    progress["reclaimed"] += reclaim_expired_vouchers()
+    budget = pacer.budget()
+    stats = {}
+    drawn = do_lottery(budget, stats) if budget != 0 else 0
+    pacer.spend(drawn)
+    # Winners use up reclaimed quota first, so cron.py reclaim doesn't draw
+    # for it again
+    if drawn:
+        mark_reoffered(drawn * vouchers_per_winner)
+    progress["rounds"] += 1
+    progress["drawn"] += drawn
+    progress.update(last_drawn = drawn, state = "idle")
+    if stats:
+        progress.update(eligible = stats["eligible"] - drawn, last_timings = stats["timings"])
+
+if __name__ == '__main__':
+    lock = advisory_lock("draw")
+    if not lock:
+        sys.exit("Someone else is drawing, see /api/admin/draw")
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    progress = { "host": socket.gethostname(), "pid": os.getpid(),
+                 "started": datetime.utcnow(), "interval": interval,
+                 "rate_per_minute": rate or None, "rounds": 0, "drawn": 0,
+                 "reclaimed": 0, "eligible": None, "last_drawn": 0 }
+    pacer = Pacer(rate)
+    while not stopping:
+        # Dies if the lock's connection went away, someone else may have it now
+        lock.execute("SELECT 1")
+        started = time.monotonic()
+        try:
+            run_round(pacer, progress)
+        except Exception as e:
+            db.session.rollback()
+            progress.update(state = "failed", error = str(e))
+            log.exception("Scheduler: draw round failed")
+        progress["next_round"] = datetime.utcnow() + timedelta(
+            seconds = max(0, interval - (time.monotonic() - started)))
+        WorkerStatus.save("draw", progress)
+        db.session.remove()
+        while not stopping and time.monotonic() - started < interval:
+            time.sleep(min(1, interval))
+    progress.update(state = "stopped", next_round = None)
+    WorkerStatus.save("draw", progress)
@@ -0,0 +1,103 @@
+from main import *
+import sys
+import json
+import time
+from datetime import datetime
+import pretix
+
+# Mirrors Pretix' orders, our vouchers and the quotas into local tables every
+# PRETIX_SYNC_INTERVAL seconds, so the webhook worker and the draw can read
+# them instead of asking Pretix. Orders are fetched by modification time from
+# where the last sync left off, vouchers newest first until known ones turn
+# up, and quotas whole, they're few. Each round then reconciles paid orders
+# whose vouchers never heard about it.
+paid_action = "pretix.event.order.paid"
+
+def sync_orders():
+    since = db.session.query(func.max(PretixOrder.last_modified)).scalar()
+    params = { "ordering": "last_modified" }
+    if since:
+        params["modified_since"] = since.isoformat() + "Z"
+    synced = 0
+    for page in pretix.pages("sync_orders", "orders/", params):
+        store_mirrored(PretixOrder, [ PretixOrder.row(o) for o in page ])
+        db.session.commit()
+        synced += len(page)
+    return synced
+
+# Pretix can't list vouchers by modification time, so new ones are found
+# newest first. Until one pass has gone all the way through, older pages may
+# be missing and every pass does.
+def sync_vouchers(progress):
+    synced = 0
+    for page in pretix.pages("sync_vouchers", "vouchers/", { "tag": "lottery", "ordering": "-id" }):
+        ids = [ v["id"] for v in page ]
+        known = { i for (i,) in db.session.query(PretixVoucher.id).filter(PretixVoucher.id.in_(ids)) }
+        store_mirrored(PretixVoucher, [ PretixVoucher.row(v) for v in page ])
+        db.session.commit()
+        synced += len(page)
+        if progress.get("vouchers_complete") and len(known) == len(ids):
+            return synced
+    progress["vouchers_complete"] = True
+    return synced
+
+def sync_quotas():
+    rows = []
+    for page in pretix.pages("sync_quotas", "quotas/"):
+        for quota in page:
+            r = pretix.client.get("quota_availability", "quotas/{}/availability/".format(quota["id"]))
+            if pretix.check_response(r, 200, "get availability of quota {}".format(quota["id"])):
+                rows.append(PretixQuota.row(quota, r.json()))
+    store_mirrored(PretixQuota, rows)
+    db.session.commit()
+    return len(rows)
+
+# Paid orders for our vouchers that no notification ever arrived for are
+# queued for webhooks.py as if Pretix had sent one
+def reconcile():
+    missing = PretixOrder.join_vouchers(db.session.query(PretixOrder.code)).filter(
+        PretixOrder.status == "p", Voucher.order == None,
+        ~db.exists().where(db.and_(PretixNotification.code == PretixOrder.code,
+                                   PretixNotification.action == paid_action))).distinct()
+    codes = [ code for (code,) in missing ]
+    for code in codes:
+        log.warn("Sync: {} was paid but never notified, queueing it".format(code))
+        PretixNotification.store({ "action": paid_action, "code": code, "reconciled": True })
+    return len(codes)
+
+def sync(progress):
+    timings = {}
+    with metrics.timed(timings, "orders"):
+        progress["orders"] = sync_orders()
+    with metrics.timed(timings, "vouchers"):
+        progress["vouchers"] = sync_vouchers(progress)
+    with metrics.timed(timings, "quotas"):
+        progress["quotas"] = sync_quotas()
+    with metrics.timed(timings, "reconcile"):
+        progress["reconciled"] = reconcile()
+    progress.update(last_sync = datetime.utcnow(), timings = timings, state = "idle")
+    progress.pop("error", None)
+    for phase, seconds in timings.items():
+        metrics.count("lotto_pretix_sync_seconds_total", seconds, phase=phase)
+
+if __name__ == '__main__':
+    lock = advisory_lock("pretix-sync")
+    if not lock:
+        sys.exit("sync.py is already running")
+    status = WorkerStatus.query.get("pretix-sync")
+    progress = status and json.loads(status.status) or {}
+    while True:
+        started = time.monotonic()
+        try:
+            sync(progress)
+        except Exception as e:
+            db.session.rollback()
+            progress.update(state = "failed", error = str(e))
+            log.exception("Sync: failed")
+        WorkerStatus.save("pretix-sync", progress)
+        metrics.dump()
+        db.session.remove()
+        # python sync.py --once syncs and exits
+        if "--once" in sys.argv:
+            break
+        time.sleep(max(0, pretix_sync_interval - (time.monotonic() - started)))
@@ -0,0 +1,130 @@
+import os
+import unittest
+from datetime import datetime, timedelta
+from fakes import FakeIssuer
+
+# The registration page is polled by everyone, so it has to stay at a fixed
+# number of queries however many have registered. The answer counters are
+# checked against a recount here too. Needs a scratch Postgres database, run
+# from backend/app like bench.py:
+#
+#   TEST_DB=postgresql://localhost/lotto_test PYTHONPATH=app python -m unittest test_queries
+#
+# TEST_DB is wiped.
+
+test_db = os.getenv("TEST_DB")
+
+@unittest.skipUnless(test_db, "Set TEST_DB to a scratch database, it will be wiped")
+class RegistrationQueries(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.issuer = FakeIssuer()
+        os.environ.update({ "LOTTO_DB": test_db,
+                            "OIDC_ISSUER": cls.issuer.issuer,
+                            "OIDC_JWKS_URI": cls.issuer.jwks_uri,
+                            "OIDC_VALIDATION": "local",
+                            "LOTTERY_CACHE_TTL": "3600",
+                            "AUDIT_FLUSH_INTERVAL": "3600" })
+        global main, models
+        import main
+        import models
+        from test_data import db_test_data
+        import sqlalchemy.event
+
+        main.db.drop_all()
+        main.db.create_all()
+        db_test_data()
+        # Outlives the session, which each request through the client removes
+        cls.lottery = models.LotterySnapshot(models.Lottery.query.first())
+        cls.queries = [0]
+
+        # Same as bench.py's count_query
+        @sqlalchemy.event.listens_for(main.db.engine, "before_cursor_execute")
+        def count_query(*args):
+            cls.queries[0] += 1
+
+        cls.client = main.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.issuer.close()
+
+    def register(self, n, start):
+        main.db.session.execute(models.Borderling.__table__.insert(), [
+            { "email": "borderling{}@test.invalid".format(i),
+              "lottery_id": self.lottery.id, "admin": False } for i in range(start, start + n) ])
+        main.db.session.commit()
+
+    def me(self, email):
+        u = models.Borderling.query.filter(models.Borderling.email == email).one()
+        expires = datetime.utcnow() + timedelta(days = 2)
+        main.db.session.add_all([
+            models.Voucher(code = "{}-paid".format(u.id), borderling_id = u.id,
+                           expires = expires, primary = True, order = "{}-order".format(u.id)),
+            models.Voucher(code = "{}-friend".format(u.id), borderling_id = u.id,
+                           expires = expires) ])
+        main.db.session.commit()
+        return u
+
+    def count(self, f):
+        before = self.queries[0]
+        f()
+        return self.queries[0] - before
+
+    def test_to_dict(self):
+        self.register(10, 0)
+        u = self.me("borderling0@test.invalid")
+        lottery = main.get_lottery()
+        main.db.session.refresh(u)
+        few = self.count(lambda: u.to_dict(lottery))
+        self.register(1000, 10)
+        main.db.session.refresh(u)
+        many = self.count(lambda: u.to_dict(lottery))
+        self.assertEqual(few, many)
+        # The vouchers, isRegistered and isChild don't need any
+        self.assertEqual(many, 1)
+
+    def test_registration_endpoint(self):
+        self.register(10, 2000)
+        self.me("borderling2000@test.invalid")
+        headers = { "Authorization": "Bearer " + self.issuer.token("borderling2000@test.invalid") }
+        get = lambda: self.assertEqual(
+            self.client.get("/api/registration", headers = headers).status_code, 200)
+        # Fetches the signing keys and caches the lottery
+        get()
+        few = self.count(get)
+        self.register(1000, 2010)
+        many = self.count(get)
+        self.assertEqual(few, many)
+        # The borderling and their vouchers
+        self.assertLessEqual(many, 2)
+
+    def test_answer_counts(self):
+        self.register(2, 4000)
+        emails = [ "borderling4000@test.invalid", "borderling4001@test.invalid" ]
+        volunteer, skills = [ q.id for q in models.Question.query.filter(
+            models.Question.type == "multiple").order_by(models.Question.id) ]
+        v, s = [ [ o.id for o in models.Question.query.get(q).options ] for q in (volunteer, skills) ]
+        realname = models.Question.query.filter(models.Question.tag == "realname").one().id
+        def answer(email, answers):
+            r = self.client.post("/api/answers", json = { str(q): a for q, a in answers.items() },
+                                 headers = { "Authorization": "Bearer " + self.issuer.token(email) })
+            self.assertEqual(r.status_code, 200, r.data)
+        answer(emails[0], { volunteer: [ v[0], v[1] ], realname: "A" })
+        answer(emails[1], { volunteer: [ v[1] ] })
+        # Changed options, a second question, the same answer again, and none
+        answer(emails[0], { volunteer: [ v[1], v[2] ], skills: [ s[0] ] })
+        answer(emails[0], { volunteer: [ v[1], v[2] ], realname: "B" })
+        answer(emails[1], { volunteer: [], skills: [ s[0], s[1] ] })
+        counted = lambda: { (c.lottery_id, c.question_id, c.option_id): c.count
+                            for c in models.AnswerCount.query if c.count }
+        running = counted()
+        self.assertEqual(running[(self.lottery.id, volunteer, 0)], 2)
+        self.assertEqual(running[(self.lottery.id, volunteer, v[1])], 1)
+        self.assertNotIn((self.lottery.id, volunteer, v[0]), running)
+        self.assertEqual(running[(self.lottery.id, skills, s[0])], 2)
+        models.recount_answers()
+        self.assertEqual(running, counted())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,133 +1,180 @@
-from main import app, db, oidc, jsonify, request, send_file, g, get_lottery, do_lottery
+from flask import Blueprint, Response, stream_with_context, jsonify, request, g
+from functools import wraps
+from main import log, db, get_lottery
 from models import *
+from auth import accept_token
+from assets import Assets
+import export
+import metrics
 import lottomail
 import pretix
 import json
 import os
 
+api = Blueprint("api", __name__)
+
 # Get or update users' registration status
-@app.route('/api/registration', methods=['GET', 'POST'])
-@oidc.accept_token(require_token=True)
+@api.route('/api/registration', methods=['GET', 'POST'])
+@accept_token(require_token=True)
 def registration():
-    u = get_or_create(Borderling, email=g.oidc_token_info['email'])
+    email = g.oidc_token_info['email']
     lottery = get_lottery()
-    if request.method == 'POST':
-        if lottery.registrationAllowed():
-            lottery.borderlings.append(u)
-            db.session.commit()
-            # TODO check if not already registered so we don't send additional
-            # emails
-            lottomail.registration_complete(u.email)
+    if request.method == 'POST' and lottery.registrationAllowed():
+        # One upsert and the queued confirmation, committed together
+        if register(email, lottery):
+            lottomail.registration_complete(email, commit=False)
+        db.session.commit()
+    u = get_borderling(email)
     return jsonify(u.to_dict(lottery))
 
 # Get this lottery's current status
-@app.route('/api/lottery')
-@oidc.accept_token(require_token=True)
+@api.route('/api/lottery')
+@accept_token(require_token=True)
 def lottery():
     return jsonify(get_lottery().to_dict())
 
 # Get or submit questions
-@app.route('/api/questions/<int:qs>',
+@api.route('/api/questions/<int:qs>',
            methods=['GET', 'POST'])
-@oidc.accept_token(require_token=True)
+@accept_token(require_token=True)
 def questionset(qs):
-    u = get_or_create(Borderling, email=g.oidc_token_info['email'])
+    u = get_borderling(g.oidc_token_info['email'])
     if request.method == 'POST':
-        #for k,v in request.get_json().items():
-            #if not v:
-            #    return jsonify({"result": False, "message": "Empty answer"}), 400
-        for k,v in request.get_json().items():
-            q = Question.query.filter_by(id=int(k)).first()
-            q.answer(u, v)
-            return jsonify({"result": True, "message": ""})
-    return jsonify(Questionset.query.filter_by(id=qs).first().to_dict(u))
+        return answers_response(answer_questions(u, request.get_json(), [qs]))
+    return jsonify(answered_questionset(qs, u, get_lottery().questions_version))
+
+# Submit answers to any of the lottery's questions at once
+@api.route('/api/answers', methods=['POST'])
+@accept_token(require_token=True)
+def answers():
+    u = get_borderling(g.oidc_token_info['email'])
+    return answers_response(answer_questions(u, request.get_json(),
+                                             get_lottery().questionset_ids))
+
+def answers_response(error):
+    if error:
+        return jsonify({"result": False, "message": error}), 400
+    return jsonify({"result": True, "message": ""})
 
 # Transfer a voucher ("invite") from one account's supplementary vouchers to
 # anothers main
-@app.route('/api/transfer', methods=['POST'])
-@oidc.accept_token(require_token=True)
+@api.route('/api/transfer', methods=['POST'])
+@accept_token(require_token=True)
 def transfer_voucher():
-    u = get_or_create(Borderling, email=g.oidc_token_info['email'])
-    if get_lottery().transferAllowed():
+    u = get_borderling(g.oidc_token_info['email'])
+    lottery = get_lottery()
+    if lottery.transferAllowed():
         r = request.get_json()
         voucher = Voucher.query.filter(Voucher.code == r['voucher']).first()
         dest = Borderling.query.filter(Borderling.email == r['email']).first()
         if voucher and dest:
-            result = voucher.transfer(u, dest)
-            app.logger.warn("transfer {}".format(result))
-            if result:
-                lottomail.voucher_transfer(dest.email, u.email, voucher.expires)
-            else:
+            error = voucher.transfer(u, dest)
+            log.warn("transfer {}".format(error or "done"))
+            if error == voucher_changed:
+                return jsonify(u.to_dict(lottery)), 409
+            elif error:
                 return jsonify(u.to_dict(lottery)), 401
+            lottomail.voucher_transfer(dest.email, u.email, voucher.expires)
         else:
-            app.logger.warn("transfer failed {} to {}".format(voucher, dest))
+            log.warn("transfer failed {} to {}".format(voucher, dest))
             return jsonify(u.to_dict(lottery)), 401
     return jsonify(u.to_dict(lottery))
 
 # Mark a voucher as gifted, will do the actual transfer once it's been paid in
 # the webhook
-@app.route('/api/gift', methods=['POST'])
-@oidc.accept_token(require_token=True)
+@api.route('/api/gift', methods=['POST'])
+@accept_token(require_token=True)
 def gift_voucher():
-    u = get_or_create(Borderling, email=g.oidc_token_info['email'])
+    u = get_borderling(g.oidc_token_info['email'])
     r = request.get_json()
     voucher = Voucher.query.filter(Voucher.code == r['voucher']).first()
     dest = Borderling.query.filter(Borderling.email == r['email']).first()
-    if voucher and dest and voucher.gift_to(u, dest):
-        return jsonify({"result": True,
-                        "url": "https://{}/{}/{}/redeem?voucher={}".format(host,org,event,voucher.code)
-        }), 201
-    return jsonify({"result": False}), 401
+    if not (voucher and dest):
+        return jsonify({"result": False}), 401
+    error = voucher.gift_to(u, dest)
+    if error:
+        return jsonify({"result": False, "message": error}), 409 if error == voucher_changed else 401
+    return jsonify({"result": True,
+                    "url": "https://{}/{}/{}/redeem?voucher={}".format(host,org,event,voucher.code)
+    }), 201
+
+# Only for borderlings with the admin flag, goes below accept_token
+def admin_only(view):
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if not get_borderling(g.oidc_token_info['email']).admin:
+            return jsonify({"result": False, "message": "Not an admin"}), 403
+        return view(*args, **kwargs)
+    return decorated
+
+# Registrants and their answers as csv or ndjson, streamed as it's read
+@api.route('/api/admin/export.<fmt>')
+@accept_token(require_token=True)
+@admin_only
+def export_registrants(fmt):
+    if fmt not in export.formats:
+        return jsonify({"result": False, "message": "Unknown format"}), 404
+    generate, mimetype = export.formats[fmt]
+    return Response(stream_with_context(generate(get_lottery())), mimetype=mimetype,
+                    headers={ "Content-Disposition":
+                              "attachment; filename=registrants.{}".format(fmt) })
+
+# Answer counts per question and option, without touching the answers
+@api.route('/api/admin/stats')
+@accept_token(require_token=True)
+@admin_only
+def stats():
+    return jsonify(answer_stats(get_lottery()))
 
-@app.route('/')
+# Progress of the draw scheduler
+@api.route('/api/admin/draw')
+@accept_token(require_token=True)
+@admin_only
+def draw_status():
+    status = WorkerStatus.query.get("draw")
+    return jsonify(status and status.to_dict() or {})
+
+assets = None
+
+# Replaces flask's own /static/<path> handler once registered on the app
+@api.record_once
+def setup_assets(state):
+    global assets
+    assets = Assets(state.app.static_folder)
+    state.app.view_functions['static'] = route_static
+
+@api.route('/')
 def route_root():
-    index_path = os.path.join(app.static_folder, 'index.html')
-    return send_file(index_path)
+    return assets.index_response()
+
+def route_static(filename):
+    return assets.response(filename) or ("Not found", 404)
 
-# Called by Pretix when an order has been paid, so we can do gifting and update the status.
-# Here be dragons: a lot of this belongs in the model
-@app.route('/_/webhooks/pretix', methods=['POST'])
+# The fingerprinted URLs index.html refers to
+@api.route('/assets/<path:filename>')
+def route_assets(filename):
+    return route_static(filename)
+
+# Called by Pretix when an order has been paid, so we can do gifting and update
+# the status. The notification is only stored here, webhooks.py processes it.
+@api.route('/_/webhooks/pretix', methods=['POST'])
 def pretix_webhook():
-    d = request.get_json()
-    if d['action'] == "pretix.event.order.paid":
-        #{"notification_id": 117, "organizer": "borderland", "event": "test", "code": "Z9M9V", "action": "pretix.event.order.paid"}
-        orderinfo = pretix.order_info(d['code'])
-        orderposition = orderinfo['positions'][0] # TODO assumes only one product, this assumption is prevalent
-        pretix_voucher = pretix.voucher_info(orderposition['voucher'])
-        app.logger.info("Webhook order.paid: {} for {}".format(d['code'], pretix_voucher))
-        voucher = Voucher.query.filter(Voucher.code == pretix_voucher['code']).first()
-        borderling = Borderling.query.filter(Borderling.id == voucher.borderling_id).first()
-        if voucher:
-            # update order info
-            voucher.order = d['code']
-            voucher.secret = orderinfo['secret']
-            if voucher.gifted_to:
-                recipient = Borderling.query.filter(Borderling.id == Voucher.gifted_to).first()
-                if Voucher.query.filter(Voucher.borderling_id == recipient.id, Voucher.order != None):
-                    app.logger.info("Webhook: transfering gifted voucher from {} to {}".format(borderling, recipient))
-                    if voucher.move(borderling, recipient):
-                        lottomail.gifted_ticket(recipient.email, borderling.email)
-                        pretix.update_order_name(d['code'], borderling.pretix_name())
-                else:
-                    app.logger.error("Webhook: Order {} gifted to {} who already has ticket".format(d['code'], recipient))
-            else:
-                app.logger.info("Webhook: purchase completed for {}".format(borderling))
-                lottomail.order_complete(borderling.email)
-                pretix.update_order_name(d['code'], borderling.pretix_name())
-        db.session.commit()
+    PretixNotification.store(request.get_json())
     return "k"
 
+# Counters and histograms from all workers, for Prometheus. Internal only,
+# see metrics.allowed
+@api.route('/_/metrics')
+def metrics_endpoint():
+    if not metrics.allowed(request):
+        return "Not found", 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 
 # Default catch-all
-@app.route('/<path:path>')
+@api.route('/<path:path>')
 def route_frontend(path):
     # ...could be a static file needed by the front end that
     # doesn't use the `static` path (like in `<script src="bundle.js">`)
-    file_path = os.path.join(app.static_folder, path)
-    if os.path.isfile(file_path):
-        return send_file(file_path)
     # ...or should be handled by the SPA's "router" in front end
-    else:
-        index_path = os.path.join(app.static_folder, 'index.html')
-        return send_file(index_path)
-
+    return assets.response(path) or assets.index_response()
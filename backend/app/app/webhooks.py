@@ -0,0 +1,98 @@
+from main import *
+import os
+import sys
+import time
+import traceback
+from datetime import datetime, timedelta
+import pretix
+import lottomail
+import metrics
+import audit
+
+# Processes the notifications stored by the Pretix webhook, oldest first.
+# Each notification is one transaction, committed by process_pending along
+# with its processed mark, so the handlers don't commit. Failures are rolled
+# back as a whole and retried with exponential backoff.
+batch_size = int(os.getenv("WEBHOOK_BATCH_SIZE") or 50)
+max_attempts = int(os.getenv("WEBHOOK_MAX_ATTEMPTS") or 10)
+poll_interval = float(os.getenv("WEBHOOK_POLL_INTERVAL") or 2)
+
+# Here be dragons: a lot of this belongs in the model
+def order_paid(d):
+    #{"notification_id": 117, "organizer": "borderland", "event": "test", "code": "Z9M9V", "action": "pretix.event.order.paid"}
+    order = pretix.order(d['code'])
+    if not order:
+        raise RuntimeError("No order info for {}".format(d['code']))
+    if not order.voucher_ids: # TODO assumes only one product, this assumption is prevalent
+        log.warn("Webhook order.paid: {} without voucher".format(d['code']))
+        return
+    if order.paid_voucher():
+        log.info("Webhook order.paid: {} already recorded".format(d['code']))
+        return
+    pretix.mirror_order_vouchers(order)
+    voucher = order.unpaid_voucher()
+    log.info("Webhook order.paid: {} for {}".format(d['code'], voucher))
+    if not voucher:
+        log.warn("Webhook order.paid: none of vouchers {} is ours and unpaid".format(order.voucher_ids))
+        return
+    borderling = Borderling.query.filter(Borderling.id == voucher.borderling_id).first()
+    # update order info
+    if not voucher.mark_paid(d['code'], order.secret):
+        log.error("Webhook order.paid: {} already paid by order {}".format(voucher, voucher.order))
+        return
+    audit.record_change("voucher.paid", borderling_id=voucher.borderling_id, voucher_id=voucher.id,
+                        detail={ "order": d['code'], "notification": d.get('notification_id') })
+    if voucher.gifted_to:
+        recipient = Borderling.query.filter(Borderling.id == voucher.gifted_to).first()
+        if not Voucher.query.filter(Voucher.borderling_id == recipient.id, Voucher.order != None).first():
+            log.info("Webhook: transfering gifted voucher from {} to {}".format(borderling, recipient))
+            if not voucher.move(borderling, recipient, commit=False):
+                # Rolled back along with the payment, try it all again
+                raise RuntimeError("{} changed while being moved".format(voucher))
+            lottomail.gifted_ticket(recipient.email, borderling.email, commit=False)
+            pretix.update_order_name(d['code'], borderling.pretix_name())
+        else:
+            log.error("Webhook: Order {} gifted to {} who already has ticket".format(d['code'], recipient))
+    else:
+        log.info("Webhook: purchase completed for {}".format(borderling))
+        lottomail.order_complete(borderling.email, commit=False)
+        pretix.update_order_name(d['code'], borderling.pretix_name())
+
+handlers = { "pretix.event.order.paid": order_paid }
+
+def process_pending():
+    notifications = PretixNotification.query.filter(
+        PretixNotification.processed == None,
+        PretixNotification.next_attempt <= datetime.utcnow(),
+        PretixNotification.attempts < max_attempts).order_by(
+            PretixNotification.id).limit(batch_size).all()
+    for n in notifications:
+        try:
+            handler = handlers.get(n.action)
+            if handler:
+                handler(n.data())
+            n.processed = datetime.utcnow()
+        except Exception as e:
+            db.session.rollback()
+            n.attempts += 1
+            n.error = traceback.format_exc()[-5000:]
+            n.next_attempt = datetime.utcnow() + timedelta(seconds = min(10 * 2**n.attempts, 3600))
+            log.error("Webhook: failed processing {} (attempt {}): {}".format(n, n.attempts, e))
+        db.session.commit()
+        metrics.count("lotto_webhooks_total", action=n.action or "", ok=str(n.processed is not None))
+    if notifications:
+        metrics.dump()
+        audit.flush()
+    return len(notifications)
+
+if __name__ == '__main__':
+    # Notifications have to be processed in order, so only one of us may run
+    lock = advisory_lock("webhooks")
+    if not lock:
+        sys.exit("webhooks.py is already running")
+    # python webhooks.py --once processes everything due and exits
+    while True:
+        if not process_pending():
+            if "--once" in sys.argv:
+                break
+            time.sleep(poll_interval)